@@ -15,42 +15,90 @@ report2:
     requires: [report1]
     locks: [statusdb]
     cwd: report2
+    maxtime: auto
 
 report3:
     when: hourly
     command: python report2.py
     requires: [report1]
-    locks: [statusdb]
+    locks: {statusdb: 2}
+    slots: 2
     cwd: report2
     copy_files:
         - flot/
+
+resources:
+    statusdb: 3
+
+`locks` name counting semaphores whose capacities are set in the top level
+`resources` section (locks not listed there have a capacity of 1). A list of
+locks takes one unit of each; a mapping says how many units to take.
+
+`slots` is how many of the global job slots (reportor --jobs) a report uses
+while it's running; it defaults to 1.
+
+Reports with `runner: python` are run by a pre-forked worker that already
+has common modules imported, rather than by a new shell and interpreter (see
+reportor.workers). Their `command` should be a Python script and its
+arguments, optionally preceded by the interpreter.
+
+Reports write into a staging directory, which is renamed into place once the
+report has succeeded, so readers never see partially written output. Output
+from an earlier run is swapped out atomically where the system supports it
+(renameat2 with RENAME_EXCHANGE). The output of failed runs is moved to
+.failed/<report> under the dated directory instead.
+
+`maxtime` is how many seconds a report may run for before it's killed
+(default 3600). `maxtime: auto` uses the 99th percentile of the report's
+recent runtimes times `maxtime_factor` (default 3), but no less than
+`maxtime_min` (default 60). Reports are sent SIGTERM, and then SIGKILL if
+they're still running `kill_grace` seconds (default 30) later. Signals go to
+the report's whole process group.
+
+Reports with a `capture` section have their output streamed through pipes,
+with rotation and compression, and can be watched while they run (see
+reportor.capture).
+
+Reports run together share a cache of expensive fetches, which is removed
+once they've all finished (see reportor.cache).
+
+Reports can keep state between runs in reportor.utils.report_state_dir(),
+which is under reportor's state directory (REPORTOR_STATE_DIR) when run by
+reportor, and record values over time with reportor.series. The output of
+their previous successful run is in REPORTOR_PREVIOUS_OUTPUT, when there is
+one (see reportor.index).
 """
 import os
 import time
+import errno
+import signal
 import logging
 import subprocess
 import glob
 import shutil
 import calendar
+import resource
+import tempfile
 from datetime import datetime
 
 import yaml
 
+from reportor.scheduler import Scheduler, exitstatus_to_returncode
+from reportor.copier import Copier, walk_files
+from reportor.workers import parse_command
+from reportor.capture import Capture
+from reportor.utils import exchange
+
 log = logging.getLogger(__name__)
 
+DEFAULT_MAXTIME = 3600
+
 
 def copyfile(src, dst):
     """
     Copies src to dst if src is newer than dst
     """
-    if not os.path.exists(dst) or os.path.getmtime(src) > os.path.getmtime(dst):
-        log.info("Copying %s to %s", src, dst)
-        dst_dir = os.path.dirname(dst)
-        if not os.path.exists(dst_dir):
-            os.makedirs(dst_dir)
-        shutil.copyfile(src, dst)
-        shutil.copymode(src, dst)
-        shutil.copystat(src, dst)
+    Copier().copy([(src, dst)])
 
 
 class ReportRun:
@@ -59,27 +107,74 @@ class ReportRun:
     proc = None
     start_time = None
     end_time = None
+    returncode = None
+    rusage = None
+    inherited_max_rss = None
+    killed = False
+    bytes_written = None
+    cache_key = None
+    cached = False
+    failed_to_start = False
+    capture = None
 
-    def __init__(self, name, config, basedir, now):
+    def __init__(self, name, config, basedir, now, history=None, incremental=None, store=None,
+                 workers=None, index=None, cache_dir=None):
         self.name = name
         self.config = config
         self.cwd = config.get('cwd', name)
         self.basedir = basedir
         self.now = now
+        self.history = history
+        self.incremental = incremental
+        self.store = store
+        self.workers = workers
+        self.index = index
         env = os.environ.copy()
-        self.output_dir = os.path.join(basedir, name)
         env.update({
-            'OUTPUT_DIR': self.output_dir,
             'REPORTOR_NOW': str(calendar.timegm(now.utctimetuple())),
+            'REPORTOR_NAME': name,
         })
+        if cache_dir:
+            env['REPORTOR_CACHE_DIR'] = cache_dir
         if os.path.exists('credentials.ini'):
             env['REPORTOR_CREDS'] = os.path.abspath('credentials.ini')
+        env.pop('REPORTOR_PREVIOUS_OUTPUT', None)
+        if index:
+            previous = index.previous(name, before=int(env['REPORTOR_NOW']))
+            if previous:
+                env['REPORTOR_PREVIOUS_OUTPUT'] = previous['output_dir']
         self.env = env
-        self.stdout_path = os.path.join(self.output_dir, config.get('stdout', 'output.txt'))
-        self.stderr_path = os.path.join(self.output_dir, config.get('stderr', 'logs/output.log'))
+        # Where our output ends up once we've succeeded; until then it's
+        # written into the staging directory next to it
+        self.publish_dir = os.path.join(basedir, name)
+        self.staging_dir = os.path.join(basedir, '.%s.staging' % name)
+        self.set_output_dir(self.staging_dir)
+        self.maxtime = self.get_maxtime()
+        self.kill_grace = config.get('kill_grace', 30)
+
+    def set_output_dir(self, output_dir):
+        self.output_dir = output_dir
+        self.env['OUTPUT_DIR'] = output_dir
+        self.stdout_path = os.path.join(output_dir, self.config.get('stdout', 'output.txt'))
+        self.stderr_path = os.path.join(output_dir, self.config.get('stderr', 'logs/output.log'))
+
+    def get_maxtime(self):
+        maxtime = self.config.get('maxtime', DEFAULT_MAXTIME)
+        if maxtime != 'auto':
+            return maxtime
+
+        if self.history:
+            maxtime = self.history.auto_maxtime(self.name, self.config.get('maxtime_factor', 3))
+        if maxtime is None or maxtime == 'auto':
+            log.debug("%s: not enough history for an automatic maxtime", self.name)
+            return DEFAULT_MAXTIME
+        maxtime = max(maxtime, self.config.get('maxtime_min', 60))
+        log.debug("%s: using a maxtime of %is", self.name, maxtime)
+        return maxtime
 
     def copy_files(self):
         # Copy files specified
+        pairs = []
         for pat in self.config.get('copy_files', []):
             if not isinstance(pat, basestring) and len(pat) == 2:
                 src, dst_path = pat
@@ -90,122 +185,291 @@ class ReportRun:
             for f in glob.glob(os.path.join(self.cwd, src)):
                 if os.path.isdir(f):
                     assert os.path.isdir(dst_path)
-                    for root, dirs, files in os.walk(f):
-                        for src_file in files:
-                            src_name = os.path.join(root, src_file)
-                            rel_name = os.path.relpath(src_name, self.cwd)
-                            dst_name = os.path.join(dst_path, rel_name)
-                            copyfile(src_name, dst_name)
+                    for entry in walk_files(f):
+                        rel_name = os.path.relpath(entry.path, self.cwd)
+                        pairs.append((entry, os.path.join(dst_path, rel_name)))
+                    continue
 
                 if os.path.isdir(dst_path):
-                    dst = os.path.join(dst_path, os.path.basename(f))
-                    copyfile(f, dst)
+                    pairs.append((f, os.path.join(dst_path, os.path.basename(f))))
                 else:
                     print "uh oh"
 
+        if not pairs:
+            return
+        if self.store:
+            copier = Copier(install=self.store.install)
+        else:
+            copier = Copier()
+        stats = copier.copy(pairs)
+        log.info("%s: %s", self.name, stats)
+
     def start(self):
         self.start_time = time.time()
 
-        if not os.path.exists(self.output_dir):
-            os.makedirs(self.output_dir)
+        if os.path.exists(self.staging_dir):
+            # Left over from a run that didn't finish
+            shutil.rmtree(self.staging_dir)
+        os.makedirs(self.staging_dir)
 
         if 'command' not in self.config:
             self.end_time = time.time()
             return
 
+        if self.incremental:
+            self.cache_key = self.incremental.cache_key(self)
+            if self.cache_key and self.incremental.reuse(self, self.cache_key):
+                self.cached = True
+                self.end_time = time.time()
+                return
+
         stdout_dir = os.path.dirname(self.stdout_path)
         stderr_dir = os.path.dirname(self.stderr_path)
         if not os.path.exists(stdout_dir):
             os.makedirs(stdout_dir)
         if not os.path.exists(stderr_dir):
             os.makedirs(stderr_dir)
-        self.stdout = open(self.stdout_path, 'wb')
-        self.stderr = open(self.stderr_path, 'wb')
+        if self.config.get('capture'):
+            self.capture = Capture(self.name, self.config['capture'], self.stdout_path, self.stderr_path)
+            self.stdout, self.stderr = self.capture.open_streams()
+            stdout_path, stderr_path = self.capture.stdout_fifo, self.capture.stderr_fifo
+        else:
+            self.stdout = open(self.stdout_path, 'wb')
+            self.stderr = open(self.stderr_path, 'wb')
+            stdout_path, stderr_path = self.stdout_path, self.stderr_path
         devnull = open(os.devnull, 'rw')
         try:
             log.debug("%s: command: %s", self.name, self.config['command'])
             log.debug("%s: cwd: %s", self.name, self.cwd)
-            self.proc = subprocess.Popen(self.config['command'], shell=True, cwd=self.cwd,
-                                         env=self.env, stdout=self.stdout,
-                                         stderr=self.stderr, stdin=devnull)
-        except OSError, e:
+            # Linux carries the peak RSS of the process we're forked from
+            # over exec, so our report's ru_maxrss is never lower than this
+            self.inherited_max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if self.config.get('runner') == 'python' and self.workers:
+                argv = parse_command(self.config['command'])
+                self.proc = self.workers.spawn(argv, self.cwd, self.env, stdout_path, stderr_path)
+            else:
+                # Run in our own process group, so that kill() gets any
+                # children as well
+                self.proc = subprocess.Popen(self.config['command'], shell=True, cwd=self.cwd,
+                                             env=self.env, stdout=self.stdout,
+                                             stderr=self.stderr, stdin=devnull,
+                                             preexec_fn=os.setpgrp)
+        except (OSError, ValueError), e:
             log.debug("%s: failed to start", self.name, exc_info=True)
+            self.failed_to_start = True
             self.stdout.close()
             self.stderr.write(str(e))
             self.stderr.close()
+            if self.capture:
+                self.capture.finish()
             self.end_time = time.time()
 
     @property
-    def alive(self):
-        if self.proc is None or self.proc.poll() is not None:
+    def pid(self):
+        if self.proc is None:
+            return None
+        return self.proc.pid
+
+    def reaped(self, status, rusage):
+        """Called by the scheduler once our process has been reaped"""
+        self.end_time = time.time()
+        self.returncode = exitstatus_to_returncode(status)
+        self.rusage = rusage
+        # Let Popen know that the process is gone
+        self.proc.returncode = self.returncode
+        if self.killed:
+            # Don't leave anything behind that could be holding on to
+            # resources
+            self.send_signal(signal.SIGKILL)
+
+    @property
+    def succeeded(self):
+        if self.failed_to_start:
             return False
-        else:
-            return True
+        return self.proc is None or self.returncode == 0
 
     def wait(self):
         if self.proc:
             self.proc.wait()
             self.end_time = time.time()
-        self.copy_files()
+            self.stdout.close()
+            self.stderr.close()
+            if self.capture:
+                self.capture.finish()
+        if self.succeeded:
+            self.copy_files()
+            if self.store and self.proc:
+                self.store.dedupe(self.output_dir)
+            self.publish()
+        else:
+            self.discard()
+        if (self.proc or self.failed_to_start) and self.history:
+            self.bytes_written = self.output_size()
+            self.history.record(self)
+        if self.incremental:
+            self.incremental.finish(self)
+        if self.index:
+            self.index.record(self)
+
+    def publish(self):
+        """Moves our output from the staging directory into place"""
+        if os.path.exists(self.publish_dir) and exchange(self.staging_dir, self.publish_dir):
+            # We've replaced the output of an earlier run without it ever
+            # being missing; it's now in the staging directory
+            shutil.rmtree(self.staging_dir)
+        else:
+            old_dir = None
+            if os.path.exists(self.publish_dir):
+                # Without an atomic exchange there's a moment where there's
+                # no output at all
+                old_dir = os.path.join(self.basedir, '.%s.old' % self.name)
+                if os.path.exists(old_dir):
+                    shutil.rmtree(old_dir)
+                os.rename(self.publish_dir, old_dir)
+            os.rename(self.staging_dir, self.publish_dir)
+            if old_dir:
+                shutil.rmtree(old_dir)
+        self.set_output_dir(self.publish_dir)
+
+    def discard(self):
+        """Moves the output of a failed run out of the way"""
+        failed_dir = os.path.join(self.basedir, '.failed', self.name)
+        if os.path.exists(failed_dir):
+            shutil.rmtree(failed_dir)
+        elif not os.path.exists(os.path.dirname(failed_dir)):
+            os.makedirs(os.path.dirname(failed_dir))
+        os.rename(self.staging_dir, failed_dir)
+        self.set_output_dir(failed_dir)
+        log.warn("%s: failed; its output is in %s", self.name, failed_dir)
+
+    def log_files(self):
+        """Returns the paths of our stderr logs"""
+        if not self.capture:
+            return [self.stderr_path]
+        stderr_dir = os.path.dirname(self.stderr_path)
+        return [os.path.join(stderr_dir, os.path.basename(f)) for f in self.capture.files
+                if os.path.basename(f).startswith(os.path.basename(self.stderr_path))]
 
-    def kill(self):
+    def output_size(self):
+        """Returns the total size of the files in our output directory"""
+        size = 0
+        for root, dirs, files in os.walk(self.output_dir):
+            for f in files:
+                size += os.lstat(os.path.join(root, f)).st_size
+        return size
+
+    def send_signal(self, signum):
+        """Sends signum to our process group"""
+        try:
+            os.killpg(self.proc.pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def kill(self, signum=signal.SIGKILL):
         if self.proc:
-            self.proc.kill()
+            self.killed = True
+            self.send_signal(signum)
 
 
-def parse_manifest(m, whens):
+class Manifest(dict):
     """
-    Returns a parsed version of the manfiest
+    A mapping of report name to config, plus the manifest's resource
+    capacities
+    """
+    def __init__(self, reports, resources=None):
+        dict.__init__(self, reports)
+        self.resources = resources or {}
+
+
+def load_manifest(m):
+    """
+    Returns all the reports in a manifest
     """
     # TODO: some validation
     m = yaml.safe_load(m)
+    resources = m.get('resources')
+    if resources is not None and 'when' not in resources:
+        # This is the resources section, rather than a report named "resources"
+        del m['resources']
+    else:
+        resources = {}
+    return Manifest(m, resources)
+
+
+def parse_manifest(m, whens):
+    """
+    Returns a parsed version of the manfiest
+    """
+    m = load_manifest(m)
     for name, config in m.items():
         if config['when'] not in whens:
             del m[name]
     return m
 
 
-def run_manifest(m, basedir, now):
-    to_run = m.items()
-    running = []
-    finished = set()
-    held_locks = set()
-    while to_run or running:
-        for name, config in to_run[:]:
-            # Check to see if our upstreams are done
-            if 'requires' in config:
-                waiting = set(config['requires']) - finished
-                if waiting:
-                    log.debug("%s is still waiting for report %s", name, waiting)
-                    continue
-            # Check to see if locks are being held
-            if 'locks' in config:
-                waiting = set(config['locks']) & held_locks
-                if waiting:
-                    log.debug("%s is still waiting for lock %s", name, waiting)
-                    continue
+def default_state_dir(output_dir):
+    """
+    Returns where reportor keeps its own state for the output_dir pattern:
+    a .reportor directory next to the first dated component
+    """
+    parts = []
+    for part in output_dir.split(os.sep):
+        if '%' in part:
+            break
+        parts.append(part)
+    prefix = os.sep.join(parts)
+    if not prefix:
+        prefix = os.sep if output_dir.startswith(os.sep) else os.curdir
+    return os.path.join(prefix, '.reportor')
 
-            # All set!
-            # Let's run it!
-            log.info("%s: starting", name)
-            proc = ReportRun(name, config, basedir, now)
-            proc.start()
-            held_locks |= set(config.get('locks', []))
-            running.append((name, config, proc))
-            to_run.remove((name, config))
-
-        # Wait for stuff to happen
-        time.sleep(0.1)
-
-        # Check our running stuff
-        for name, config, proc in running[:]:
-            if not proc.alive:
-                proc.wait()
-                log.info("%s: finished (%is elapsed)", name, proc.end_time - proc.start_time)
-                finished.add(name)
-                held_locks -= set(config.get('locks', []))
-                running.remove((name, config, proc))
-            else:
-                if time.time() - proc.start_time > config.get('maxtime', 3600):
-                    log.info("killing %s; it's taking too long", name)
-                    proc.kill()
+
+def update_symlink(output_dir, symlink):
+    """
+    Points symlink at output_dir. The new symlink is renamed over the old
+    one, so that it always exists.
+    """
+    abs_symlink = os.path.abspath(symlink)
+    rel_symlink = os.path.relpath(os.path.abspath(output_dir), os.path.dirname(abs_symlink))
+    log.debug("%s -> %s", abs_symlink, rel_symlink)
+    try:
+        tmp_symlink = "%s.tmp.%i" % (abs_symlink, os.getpid())
+        os.symlink(rel_symlink, tmp_symlink)
+        os.rename(tmp_symlink, abs_symlink)
+    except OSError:
+        log.error("Couldn't update symlink %s", abs_symlink, exc_info=True)
+
+
+def uses_workers(m):
+    """Returns whether any of the reports in manifest m run in workers"""
+    return any(config.get('runner') == 'python' for config in m.values())
+
+
+def make_run_cache(basedir):
+    """Returns a new directory in basedir for the cache shared by a batch of
+    reports (see reportor.cache). Each batch gets its own, since batches
+    from different schedules can share basedir."""
+    return tempfile.mkdtemp(prefix='.cache-', dir=basedir)
+
+
+def remove_run_cache(cache_dir):
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+
+
+def run_manifest(m, basedir, now, jobs=None, history=None, incremental=None, store=None, workers=None,
+                 index=None):
+    estimate = history.estimate if history else None
+    scheduler = Scheduler(jobs=jobs, resources=getattr(m, 'resources', None), estimate=estimate)
+
+    cache_dir = make_run_cache(basedir)
+    if incremental:
+        incremental = incremental.batch()
+
+    def make_run(name, config):
+        return ReportRun(name, config, basedir, now, history, incremental, store, workers, index, cache_dir)
+    scheduler.submit(m, make_run)
+    scheduler.run()
+    remove_run_cache(cache_dir)
+    if store:
+        store.save()
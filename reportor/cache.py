@@ -0,0 +1,134 @@
+"""
+A key/value cache shared by the reports in a run
+
+reportor points REPORTOR_CACHE_DIR at a .cache-* directory next to the
+reports' output, one per batch of reports run together, and removes it once
+the batch is done, so expensive fetches that several reports need are only
+done once per run:
+
+    import reportor.cache
+    data = reportor.cache.shared().get_or_fetch(URL, lambda: fetch(URL))
+
+Values are strings. Entries expire after a ttl, and once the cache is bigger
+than max_bytes the least recently used entries are evicted. When several
+reports ask for the same missing key at once, one of them fetches it and
+the others wait for it.
+"""
+import os
+import time
+import errno
+import fcntl
+import hashlib
+import logging
+import tempfile
+
+from reportor.utils import atomic_write
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def cache_dir():
+    """Returns the directory of the current run's cache"""
+    return os.environ.get('REPORTOR_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'reportor-cache-%i' % os.getuid())
+
+
+class SharedCache(object):
+    def __init__(self, path=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path or cache_dir()
+        self.max_bytes = max_bytes
+        self._makedirs()
+
+    def _makedirs(self):
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, key):
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, key, ttl=None):
+        """Returns the value of key, or None if it's missing or older than ttl
+        seconds"""
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+            if ttl is not None and time.time() - st.st_mtime > ttl:
+                return None
+            with open(path, 'rb') as f:
+                value = f.read()
+            # atime is when it was last used; mtime is when it was stored
+            os.utime(path, (time.time(), st.st_mtime))
+            return value
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def set(self, key, value):
+        self._makedirs()
+        atomic_write(self._path(key), value)
+        self.evict()
+
+    def get_or_fetch(self, key, fetch, ttl=None):
+        """Returns the value of key, calling fetch() to get it if it isn't
+        cached"""
+        value = self.get(key, ttl)
+        if value is not None:
+            return value
+        # The directory can be removed from under long running reports
+        self._makedirs()
+        with open(self._path(key) + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Someone else may have fetched it while we were waiting
+            value = self.get(key, ttl)
+            if value is None:
+                log.debug("fetching %s", key)
+                value = fetch()
+                self.set(key, value)
+            return value
+
+    def evict(self):
+        """Removes the least recently used entries until we're under
+        max_bytes"""
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for name in names:
+            if name.startswith('.') or name.endswith('.lock'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_atime, st.st_size, name))
+            total += st.st_size
+        entries.sort()
+        while total > self.max_bytes and entries:
+            _, size, name = entries.pop(0)
+            log.debug("evicting %s", name)
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+
+_shared = None
+
+
+def shared():
+    """Returns the cache for the current run"""
+    global _shared
+    if _shared is None:
+        _shared = SharedCache()
+    return _shared
@@ -0,0 +1,293 @@
+"""
+Captures a report's stdout and stderr through pipes
+
+Reports opt in with a `capture` section:
+
+report1:
+    command: python report1.py
+    capture:
+        max_bytes: 10485760
+        backups: 2
+        compress: gzip
+
+Each stream is written to its usual file until it reaches max_bytes (default
+10MB), when the file is rotated to .1, .2, and so on, keeping `backups` (default
+2) old files. Once the report is done they're compressed with `compress`
+(gzip, zstd if the zstandard module is installed, or none), so
+logs/output.log becomes logs/output.log.gz. `capture: true` uses the
+defaults.
+
+While a report is running, both of its streams can also be watched through
+a unix socket (see `reportor tail`).
+"""
+import os
+import gzip
+import errno
+import fcntl
+import select
+import shutil
+import socket
+import logging
+import tempfile
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUPS = 2
+READ_SIZE = 65536
+
+
+def tail_dir():
+    """Returns the directory that live tail sockets are created in"""
+    return os.environ.get('REPORTOR_TAIL_DIR',
+                          os.path.join(tempfile.gettempdir(), 'reportor-tail-%i' % os.getuid()))
+
+
+def tail_socket_path(name, pid=None):
+    """Returns the path of the live tail socket for report `name` run by the
+    reportor process pid (by default, this one). Including the pid keeps
+    concurrent reportors that run reports with the same name apart."""
+    if pid is None:
+        pid = os.getpid()
+    return os.path.join(tail_dir(), '%s.%i.sock' % (name, pid))
+
+
+def tail_sockets(name):
+    """Returns {pid: path} for the live tail sockets of report `name`"""
+    sockets = {}
+    prefix = '%s.' % name
+    try:
+        filenames = os.listdir(tail_dir())
+    except OSError:
+        return sockets
+    for f in filenames:
+        pid = f[len(prefix):-len('.sock')]
+        if f.startswith(prefix) and f.endswith('.sock') and pid.isdigit():
+            sockets[int(pid)] = os.path.join(tail_dir(), f)
+    return sockets
+
+
+def compressed_name(path, compress):
+    return path + {'gzip': '.gz', 'zstd': '.zst'}.get(compress, '')
+
+
+def compress_file(path, compress):
+    """Compresses path in place, returning the compressed file's path"""
+    if compress == 'gzip':
+        dst = compressed_name(path, compress)
+        with open(path, 'rb') as fsrc:
+            # No timestamp, so the same output compresses to the same bytes
+            with gzip.GzipFile(dst, 'wb', mtime=0) as fdst:
+                shutil.copyfileobj(fsrc, fdst)
+    elif compress == 'zstd':
+        dst = compressed_name(path, compress)
+        with open(path, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                zstandard.ZstdCompressor().copy_stream(fsrc, fdst)
+    else:
+        return path
+    os.unlink(path)
+    return dst
+
+
+class RotatingWriter(object):
+    """Writes to path, rotating it once it's max_bytes long"""
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.f = open(path, 'wb')
+        self.size = 0
+        self.rotations = 0
+
+    def write(self, data):
+        while data:
+            if self.size >= self.max_bytes:
+                self.rotate()
+            chunk = data[:self.max_bytes - self.size]
+            self.f.write(chunk)
+            self.size += len(chunk)
+            data = data[len(chunk):]
+
+    def rotate(self):
+        self.f.close()
+        if self.backups:
+            for i in range(self.backups - 1, 0, -1):
+                src = '%s.%i' % (self.path, i)
+                if os.path.exists(src):
+                    os.rename(src, '%s.%i' % (self.path, i + 1))
+            os.rename(self.path, self.path + '.1')
+        self.f = open(self.path, 'wb')
+        self.size = 0
+        self.rotations += 1
+
+    def files(self):
+        """Returns the files written, newest first"""
+        return [self.path] + ['%s.%i' % (self.path, i)
+                              for i in range(1, min(self.rotations, self.backups) + 1)]
+
+    def close(self):
+        self.f.close()
+
+
+def _set_cloexec(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+def _make_fifo(path):
+    if os.path.exists(path):
+        os.unlink(path)
+    os.mkfifo(path, 0o600)
+    # Opening the read end without blocking always works; then our write
+    # end keeps it from seeing EOF until we've let go of it
+    r = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    w = os.open(path, os.O_WRONLY)
+    fcntl.fcntl(r, fcntl.F_SETFL, fcntl.fcntl(r, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+    for fd in (r, w):
+        _set_cloexec(fd)
+    return r, w
+
+
+class Capture(object):
+    """
+    Captures the output of report `name` into stdout_path and stderr_path,
+    according to the report's `capture` config.
+
+    Reports write into fifos at stdout_fifo and stderr_fifo, or into the
+    files from open_streams(). Call finish() once the report has exited.
+    """
+    # How long to wait for output after the report has exited, from any
+    # children it left behind
+    linger = 5
+
+    def __init__(self, name, config, stdout_path, stderr_path):
+        if not isinstance(config, dict):
+            config = {}
+        self.name = name
+        self.compress = config.get('compress', 'gzip')
+        if self.compress == 'zstd' and zstandard is None:
+            log.warn("%s: zstandard isn't installed; using gzip", name)
+            self.compress = 'gzip'
+        max_bytes = config.get('max_bytes', DEFAULT_MAX_BYTES)
+        backups = config.get('backups', DEFAULT_BACKUPS)
+
+        self.writers = {}
+        self.fifos = []
+        self.fds = []
+        for path in (stdout_path, stderr_path):
+            fifo = os.path.join(os.path.dirname(path), '.%s.fifo' % os.path.basename(path))
+            r, w = _make_fifo(fifo)
+            self.writers[r] = RotatingWriter(path, max_bytes, backups)
+            self.fifos.append(fifo)
+            self.fds.append(w)
+        self.stdout_fifo, self.stderr_fifo = self.fifos
+        self.files = []
+
+        self.clients = []
+        self.tail_path = tail_socket_path(name)
+        self.tail_sock = self._listen()
+
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="capture-%s" % name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def open_streams(self):
+        """Returns file objects for writing to stdout and stderr, which
+        aren't inherited by other reports"""
+        streams = []
+        for fd in self.fds:
+            fd = os.dup(fd)
+            _set_cloexec(fd)
+            streams.append(os.fdopen(fd, 'wb'))
+        return streams
+
+    def _listen(self):
+        try:
+            if not os.path.exists(tail_dir()):
+                os.makedirs(tail_dir(), 0o700)
+            if os.path.exists(self.tail_path):
+                os.unlink(self.tail_path)
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.bind(self.tail_path)
+            s.listen(5)
+            _set_cloexec(s.fileno())
+            return s
+        except (OSError, socket.error):
+            log.warn("%s: couldn't listen on %s; live tail is disabled", self.name, self.tail_path,
+                     exc_info=True)
+            return None
+
+    def _broadcast(self, data):
+        for c in self.clients[:]:
+            try:
+                c.sendall(data)
+            except socket.error:
+                # Gone, or too slow to keep up
+                c.close()
+                self.clients.remove(c)
+
+    def _run(self):
+        fds = list(self.writers)
+        while fds and not self._stopping:
+            rlist = list(fds)
+            if self.tail_sock:
+                rlist.append(self.tail_sock)
+            try:
+                ready = select.select(rlist, [], [], 1)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                if fd is self.tail_sock:
+                    c, _ = self.tail_sock.accept()
+                    c.setblocking(0)
+                    self.clients.append(c)
+                    continue
+                data = os.read(fd, READ_SIZE)
+                if not data:
+                    fds.remove(fd)
+                    continue
+                self.writers[fd].write(data)
+                self._broadcast(data)
+
+    def finish(self):
+        """Waits for the last of the output, then compresses it. Returns the
+        files that were written."""
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+        for fifo in self.fifos:
+            if os.path.exists(fifo):
+                os.unlink(fifo)
+        self._thread.join(self.linger)
+        if self._thread.is_alive():
+            log.warn("%s: giving up on output from leftover processes", self.name)
+            self._stopping = True
+            self._thread.join()
+
+        if self.tail_sock:
+            self.tail_sock.close()
+            if os.path.exists(self.tail_path):
+                os.unlink(self.tail_path)
+        for c in self.clients:
+            c.close()
+        files = []
+        for r, writer in self.writers.items():
+            os.close(r)
+            writer.close()
+            for path in writer.files():
+                try:
+                    files.append(compress_file(path, self.compress))
+                except (IOError, OSError):
+                    log.warn("%s: couldn't compress %s", self.name, path, exc_info=True)
+                    files.append(path)
+        self.files = files
+        return files
@@ -0,0 +1,192 @@
+"""
+Copies lots of files quickly
+
+Each destination directory is listed once rather than stat'ed once per
+file, the stat() results of source files are kept from walking the tree to
+copying them, and large batches of files are copied by a pool of threads.
+"""
+import os
+import stat
+import errno
+import shutil
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+# Batches with fewer files than this are copied serially
+THREAD_THRESHOLD = 16
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class _DirEntry(object):
+    """A directory entry that remembers its stat() results, like os.DirEntry"""
+    def __init__(self, dirname, name):
+        self.name = name
+        self.path = os.path.join(dirname, name)
+        self._stat = None
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks:
+            if self._lstat is None:
+                self._lstat = os.lstat(self.path)
+            return self._lstat
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self, follow_symlinks=True):
+        return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+
+    def is_file(self, follow_symlinks=True):
+        return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.stat(False).st_mode)
+
+
+def list_dir(path):
+    """Returns the entries in directory path"""
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+def walk_files(top):
+    """Yields the entry of every file under top. Symlinks to files are
+    followed, so their contents get copied; like os.walk, symlinks to
+    directories aren't."""
+    dirs = [top]
+    while dirs:
+        for entry in list_dir(dirs.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+                continue
+            try:
+                if entry.is_file():
+                    yield entry
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                log.warn("%s is a broken symlink; not copying it", entry.path)
+
+
+def copy_contents(src, dst):
+    """Copies the contents of file src to dst"""
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+
+
+def copyfile(src, dst):
+    """Copies src to dst, along with its permissions and times.
+
+    dst is replaced rather than overwritten, since it may be a hardlink
+    shared with other files.
+    """
+    dst_dir = os.path.dirname(dst)
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    tmp = os.path.join(dst_dir, '.%s.tmp' % os.path.basename(dst))
+    try:
+        copy_contents(src, tmp)
+        shutil.copystat(src, tmp)
+        os.rename(tmp, dst)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class CopyStats(object):
+    def __init__(self):
+        self.copied = 0
+        self.copied_bytes = 0
+        self.skipped = 0
+        self.skipped_bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, copied, size):
+        with self._lock:
+            if copied:
+                self.copied += 1
+                self.copied_bytes += size
+            else:
+                self.skipped += 1
+                self.skipped_bytes += size
+
+    def __str__(self):
+        return "copied %i files (%i bytes), skipped %i files (%i bytes)" % (
+            self.copied, self.copied_bytes, self.skipped, self.skipped_bytes)
+
+
+class Copier(object):
+    """
+    Copies batches of (src, dst) pairs.
+
+    By default files are copied when dst is missing or older than src. If
+    install is given, install(src, dst) is called for every pair instead,
+    and should return whether it changed dst.
+    """
+    def __init__(self, threads=8, install=None):
+        self.threads = threads
+        self.install = install
+        # dst directory -> {name: stat} for the files in it
+        self._dst_index = {}
+        self._index_lock = threading.Lock()
+
+    def _dst_stat(self, dst):
+        dst_dir, name = os.path.split(dst)
+        with self._index_lock:
+            if dst_dir not in self._dst_index:
+                try:
+                    entries = list_dir(dst_dir)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    entries = []
+                self._dst_index[dst_dir] = dict((e.name, e) for e in entries)
+            entry = self._dst_index[dst_dir].get(name)
+        if entry is None:
+            return None
+        return entry.stat()
+
+    def _copy_one(self, stats, src, src_st, dst):
+        if self.install:
+            stats.add(self.install(src, dst), src_st.st_size)
+            return
+
+        dst_st = self._dst_stat(dst)
+        if dst_st is not None and src_st.st_mtime <= dst_st.st_mtime:
+            stats.add(False, src_st.st_size)
+            return
+        log.info("Copying %s to %s", src, dst)
+        copyfile(src, dst)
+        stats.add(True, src_st.st_size)
+
+    def copy(self, pairs):
+        """Copies (src, dst) pairs. src may be an entry from walk_files or
+        a path.
+
+        Returns a CopyStats.
+        """
+        stats = CopyStats()
+        jobs = []
+        for src, dst in pairs:
+            if hasattr(src, 'stat'):
+                jobs.append((stats, src.path, src.stat(), dst))
+            else:
+                jobs.append((stats, src, os.stat(src), dst))
+
+        if len(jobs) < THREAD_THRESHOLD or self.threads <= 1:
+            for job in jobs:
+                self._copy_one(*job)
+        else:
+            pool = ThreadPool(self.threads)
+            try:
+                # map() re-raises the first error
+                pool.map(lambda job: self._copy_one(*job), jobs)
+            finally:
+                pool.close()
+                pool.join()
+        return stats
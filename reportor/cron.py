@@ -0,0 +1,138 @@
+"""
+Parses `when` expressions into schedules
+
+A `when` can be one of the named buckets (hourly, daily, weekly, monthly), a
+five field cron expression ("*/15 * * * *", "30 6 * * mon-fri"), or an
+interval ("every 10m", "every 2h"). Times are in UTC. Intervals are aligned
+to the epoch, so that restarting doesn't shift them.
+"""
+import re
+import calendar
+from datetime import datetime, timedelta
+
+NAMED = {
+    'hourly': '0 * * * *',
+    'daily': '0 0 * * *',
+    'weekly': '0 0 * * 0',
+    'monthly': '0 0 1 * *',
+}
+
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+DAYS = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+
+INTERVAL_RE = re.compile(r'^(?:every\s+)?(\d+)\s*([smhd])$')
+INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+class CronError(ValueError):
+    pass
+
+
+def _parse_field(field, lo, hi, names=None):
+    """Returns the set of values matched by a single cron field"""
+    def value(v):
+        if names and v.lower() in names:
+            return names.index(v.lower()) + lo
+        try:
+            v = int(v)
+        except ValueError:
+            raise CronError("bad value %r" % v)
+        return v
+
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+            if step < 1:
+                raise CronError("bad step in %r" % field)
+        if part == '*':
+            start, end = lo, hi
+        elif '-' in part:
+            start, end = [value(v) for v in part.split('-', 1)]
+        else:
+            start = value(part)
+            end = hi if step > 1 else start
+        if start < lo or end > hi or start > end:
+            raise CronError("%r is out of range" % field)
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule(object):
+    def __init__(self, expr):
+        self.expr = expr
+        fields = expr.split()
+        if len(fields) != 5:
+            raise CronError("cron expressions need 5 fields: %r" % expr)
+        minute, hour, dom, month, dow = fields
+        self.minutes = _parse_field(minute, 0, 59)
+        self.hours = _parse_field(hour, 0, 23)
+        self.days = _parse_field(dom, 1, 31)
+        self.months = _parse_field(month, 1, 12, MONTHS)
+        # 7 is Sunday too
+        self.weekdays = set(d % 7 for d in _parse_field(dow, 0, 7, DAYS))
+        # Like cron, if both day fields are restricted, either can match
+        self.dom_restricted = dom != '*'
+        self.dow_restricted = dow != '*'
+
+    def _day_matches(self, dt):
+        dom = dt.day in self.days
+        # datetime's weekday() has Monday as 0
+        dow = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.dom_restricted and self.dow_restricted:
+            return dom or dow
+        return dom and dow
+
+    def next_after(self, dt):
+        """Returns the first time after datetime dt that matches"""
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self.months:
+                if dt.month == 12:
+                    dt = dt.replace(year=dt.year + 1, month=1, day=1, hour=0, minute=0)
+                else:
+                    dt = dt.replace(month=dt.month + 1, day=1, hour=0, minute=0)
+                continue
+            if not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+                continue
+            if dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+                continue
+            return dt
+        raise CronError("%r never matches" % self.expr)
+
+    def __str__(self):
+        return self.expr
+
+
+class IntervalSchedule(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def next_after(self, dt):
+        ts = calendar.timegm(dt.utctimetuple())
+        return datetime.utcfromtimestamp((ts // self.seconds + 1) * self.seconds)
+
+    def __str__(self):
+        return "every %is" % self.seconds
+
+
+def parse_when(when):
+    """Returns a schedule object for a `when` expression"""
+    when = str(when).strip()
+    if when in NAMED:
+        return CronSchedule(NAMED[when])
+    m = INTERVAL_RE.match(when)
+    if m:
+        seconds = int(m.group(1)) * INTERVAL_UNITS[m.group(2)]
+        if seconds < 1:
+            raise CronError("bad interval %r" % when)
+        return IntervalSchedule(seconds)
+    return CronSchedule(when)
@@ -0,0 +1,152 @@
+"""
+Runs reports on their schedules from a single long-running process
+
+The manifest is loaded once, and reloaded whenever it changes. Each report's
+`when` is parsed by reportor.cron, so besides the hourly/daily buckets it
+can be any cron expression or interval. All reports that are due at the same
+time are run together in one dated output directory, and runs from different
+schedules share one scheduler, so job slots and locks apply across all of
+them.
+"""
+import os
+import signal
+import logging
+from datetime import datetime
+
+from reportor import ReportRun, Manifest, load_manifest, update_symlink, make_run_cache, remove_run_cache
+from reportor.cron import parse_when, CronError
+from reportor.scheduler import Scheduler
+
+log = logging.getLogger(__name__)
+
+
+class Daemon(object):
+    # How often to check whether the manifest has changed, in seconds
+    reload_interval = 10
+
+    def __init__(self, manifest, output_dir, jobs=None, symlink=None,
+                 history=None, incremental=None, store=None, workers=None, index=None):
+        self.manifest = os.path.abspath(manifest)
+        self.output_dir = output_dir
+        self.symlink = symlink
+        self.history = history
+        self.incremental = incremental
+        self.store = store
+        self.workers = workers
+        self.index = index
+        estimate = history.estimate if history else None
+        self.scheduler = Scheduler(jobs=jobs, estimate=estimate)
+
+        self.m = Manifest({})
+        self.manifest_mtime = None
+        self.schedules = {}
+        self.next_fire = {}
+        self.stopping = False
+
+    def load(self):
+        """(Re)loads the manifest if it has changed"""
+        try:
+            mtime = os.stat(self.manifest).st_mtime
+        except OSError:
+            log.error("couldn't stat %s", self.manifest, exc_info=True)
+            return
+        if mtime == self.manifest_mtime:
+            return
+        self.manifest_mtime = mtime
+
+        try:
+            with open(self.manifest) as f:
+                m = load_manifest(f)
+            schedules = {}
+            for name, config in m.items():
+                when = config['when']
+                if when not in schedules:
+                    schedules[when] = parse_when(when)
+            now = datetime.utcnow()
+            next_fire = {}
+            for when, schedule in schedules.items():
+                if when in self.next_fire and str(schedule) == str(self.schedules[when]):
+                    next_fire[when] = self.next_fire[when]
+                else:
+                    # Raises for schedules that can never fire
+                    next_fire[when] = schedule.next_after(now)
+                    log.debug("%s: next run at %s", when, next_fire[when])
+        except Exception:
+            log.error("couldn't load %s; keeping the previous version", self.manifest, exc_info=True)
+            return
+
+        log.info("loaded %s", self.manifest)
+        reloaded = bool(self.schedules)
+        self.m = m
+        self.scheduler.resources = dict(m.resources)
+        self.schedules = schedules
+        self.next_fire = next_fire
+        if reloaded and self.workers:
+            # Reports may be using changed code now
+            self.workers.recycle()
+
+    def fire_due(self):
+        """Submits the reports whose schedules are due"""
+        now = datetime.utcnow()
+        due = [when for when, t in self.next_fire.items() if t <= now]
+        if not due:
+            return
+
+        run_time = min(self.next_fire[when] for when in due)
+        for when in due:
+            try:
+                self.next_fire[when] = self.schedules[when].next_after(now)
+            except CronError:
+                log.error("%s won't run again", when, exc_info=True)
+                del self.next_fire[when]
+
+        reports = Manifest(dict((name, config) for name, config in self.m.items() if config['when'] in due),
+                           self.m.resources)
+        basedir = os.path.abspath(run_time.strftime(self.output_dir))
+        if not os.path.exists(basedir):
+            os.makedirs(basedir)
+        log.info("running %s for %s in %s", ", ".join(sorted(reports)), ", ".join(sorted(due)), basedir)
+        cache_dir = make_run_cache(basedir)
+        incremental = self.incremental.batch() if self.incremental else None
+
+        def make_run(name, config):
+            return ReportRun(name, config, basedir, run_time, self.history, incremental, self.store,
+                             self.workers, self.index, cache_dir)
+
+        self.scheduler.submit(reports, make_run, on_done=lambda: self.batch_done(basedir, cache_dir))
+
+    def batch_done(self, basedir, cache_dir):
+        log.info("finished running reports in %s", basedir)
+        # Whatever goes wrong here, keep serving the other schedules
+        try:
+            remove_run_cache(cache_dir)
+            if self.symlink:
+                update_symlink(basedir, self.symlink)
+            if self.store:
+                self.store.save()
+                self.store.prune()
+        except Exception:
+            log.exception("error cleaning up after reports in %s", basedir)
+
+    def stop(self, signum=None, frame=None):
+        if not self.stopping:
+            log.info("stopping once running reports have finished")
+        self.stopping = True
+
+    def timeout(self):
+        """Returns how long to wait for before checking our schedules again"""
+        timeout = self.reload_interval
+        if self.next_fire and not self.stopping:
+            until_next = (min(self.next_fire.values()) - datetime.utcnow()).total_seconds()
+            timeout = min(timeout, until_next)
+        return max(timeout, 0)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        with self.scheduler.handling_signals():
+            while not self.stopping or self.scheduler.busy:
+                if not self.stopping:
+                    self.load()
+                    self.fire_due()
+                self.scheduler.step(self.timeout())
@@ -1,10 +1,123 @@
+"""
+Database helpers for reports
+
+Engines are created once per URL and reused, with pool settings from the
+[db_pool] section of the credentials file (pool_size, max_overflow,
+pool_recycle). Queries that take longer than slow_query seconds (from
+[db_pool] or REPORTOR_SLOW_QUERY) are logged.
+"""
 import os
+import time
+import logging
+import threading
+
 import sqlalchemy as sa
 
 from reportor.config import load_config
 
+log = logging.getLogger(__name__)
+
+POOL_DEFAULTS = {
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_recycle': 3600,
+}
+
+_lock = threading.Lock()
+# creds filename -> config
+_configs = {}
+# (url, pool settings, slow_query) -> engine
+_engines = {}
+
+
+def _creds_config():
+    filename = os.environ['REPORTOR_CREDS']
+    with _lock:
+        if filename not in _configs:
+            _configs[filename] = load_config(filename)
+        return _configs[filename]
+
+
+def pool_options(config):
+    """Returns the pool settings in config"""
+    options = dict(POOL_DEFAULTS)
+    if config.has_section('db_pool'):
+        for name in options:
+            if config.has_option('db_pool', name):
+                options[name] = config.getint('db_pool', name)
+    return options
+
+
+def time_queries(engine, slow_query):
+    """Logs the queries run through engine that take longer than slow_query
+    seconds"""
+    @sa.event.listens_for(engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.time())
+
+    @sa.event.listens_for(engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.time() - conn.info['query_start'].pop()
+        if elapsed >= slow_query:
+            log.warn("slow query (%.2fs): %s", elapsed, statement)
+
+
+def get_engine(url, pool=None, slow_query=None):
+    """Returns an engine for url, creating it the first time"""
+    pool = pool or {}
+    key = (url, tuple(sorted(pool.items())), slow_query)
+    with _lock:
+        if key not in _engines:
+            kwargs = {}
+            if not url.startswith('sqlite'):
+                # sqlite uses its own pool, which doesn't take these
+                kwargs.update(pool)
+            engine = sa.create_engine(url, **kwargs)
+            if slow_query is not None:
+                time_queries(engine, slow_query)
+            _engines[key] = engine
+        return _engines[key]
+
+
 def db_from_config(config_name, config=None):
     if config is None and 'REPORTOR_CREDS' in os.environ:
-        config = load_config(os.environ['REPORTOR_CREDS'])
+        config = _creds_config()
     url = config.get("db", config_name)
-    return sa.create_engine(url)
+    slow_query = os.environ.get('REPORTOR_SLOW_QUERY')
+    if config.has_option('db_pool', 'slow_query'):
+        slow_query = config.get('db_pool', 'slow_query')
+    if slow_query is not None:
+        slow_query = float(slow_query)
+    return get_engine(url, pool_options(config), slow_query)
+
+
+def stream_batches(db, query, params=None, batch_size=1000):
+    """Runs query on db (an engine or connection), and yields its rows in
+    lists of up to batch_size.
+
+    Rows are read from a server side cursor where the database supports
+    them, so the whole result is never held in memory.
+    """
+    if isinstance(query, basestring):
+        query = sa.text(query)
+    conn = db.connect() if isinstance(db, sa.engine.Engine) else db
+    try:
+        result = conn.execution_options(stream_results=True).execute(query, params or {})
+        try:
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            result.close()
+    finally:
+        if conn is not db:
+            conn.close()
+
+
+def stream_rows(db, query, params=None, batch_size=1000):
+    """Like stream_batches, but yields one row at a time"""
+    for rows in stream_batches(db, query, params, batch_size):
+        for row in rows:
+            yield row
@@ -1,36 +1,371 @@
 #!/usr/bin/env python
-import socket
+"""
+Submits metrics to graphite
+
+Metrics are queued, and sent to each host in batches, either in carbon's
+plaintext format or with its pickle protocol. Hosts are connected to when
+there's something to send, and a host that is down is retried with backoff
+without holding up the others. Each host's queue is bounded; when it fills
+up the oldest metrics are dropped, and counted.
+
+By default, graphite_from_config returns a SpoolingSubmitter, which appends
+metrics to a spool file and sends them from a background thread, so that
+reports don't wait on graphite. Whatever can't be sent before the report
+exits stays in the spool, and is sent by the next report that uses it.
+"""
+import os
 import time
+import fcntl
+import errno
+import socket
+import struct
+import atexit
+import threading
+import cPickle as pickle
+from collections import deque
 import reportor.config
+from reportor.utils import atomic_write
 
 import logging
 log = logging.getLogger(__name__)
 
+PROTOCOLS = ('plaintext', 'pickle')
+
+
+class _Host(object):
+    """A connection to one graphite host, and the metrics queued for it"""
+    min_backoff = 1
+    max_backoff = 60
+
+    def __init__(self, host, port, prefix, max_queue, connect_delay):
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.connect_delay = connect_delay
+        self.queue = deque()
+        self.max_queue = max_queue
+        self.dropped = 0
+        self.sent = 0
+        self.sock = None
+        self.backoff = 0
+        self.next_attempt = 0
+
+    def __str__(self):
+        return "%s:%i" % (self.host, self.port)
+
+    def put(self, name, value, timestamp):
+        if len(self.queue) >= self.max_queue:
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(("%s.%s" % (self.prefix, name), value, timestamp))
+
+    def connect(self, now):
+        if self.sock:
+            return True
+        if now < self.next_attempt:
+            return False
+        try:
+            self.sock = socket.create_connection((self.host, self.port), timeout=10)
+        except (socket.error, socket.timeout), e:
+            self.failed(now, e)
+            return False
+        log.debug("connected to %s", self)
+        if self.connect_delay:
+            # Make sure we sleep to let metrics get through. cf.
+            # https://bugzilla.mozilla.org/show_bug.cgi?id=1025145
+            time.sleep(self.connect_delay)
+        return True
+
+    def failed(self, now, e):
+        self.close()
+        self.backoff = min(max(self.backoff * 2, self.min_backoff), self.max_backoff)
+        self.next_attempt = now + self.backoff
+        log.warn("couldn't send to %s (%s); retrying in %is", self, e, self.backoff)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+def format_plaintext(metrics):
+    return "".join("%s %s %i\n" % m for m in metrics)
+
+
+def format_pickle(metrics):
+    payload = pickle.dumps([(path, (timestamp, value)) for path, value, timestamp in metrics], 2)
+    return struct.pack("!L", len(payload)) + payload
+
 
 class GraphiteSubmitter(object):
-    def __init__(self, hosts):
+    """
+    Queues metrics and sends them to graphite.
+
+    Queued metrics are sent by flush(), which is called by submit() once
+    batch_size metrics are waiting or flush_interval seconds have passed
+    since the last flush, and by wait().
+    """
+    def __init__(self, hosts, protocol='plaintext', batch_size=500, flush_interval=10,
+                 max_queue=100000, connect_delay=0):
         """hosts is a list of (hostname, port, prefix) tuples"""
+        if protocol not in PROTOCOLS:
+            raise ValueError("unknown graphite protocol %r" % protocol)
         self.hosts = hosts
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        if protocol == 'pickle':
+            self._format = format_pickle
+        else:
+            self._format = format_plaintext
 
-        self._socks = []
-        for host, port, prefix in hosts:
-            s = socket.create_connection((host, port))
-            self._socks.append((s, prefix))
+        self._hosts = [_Host(host, port, prefix, max_queue, connect_delay) for host, port, prefix in hosts]
+        self._pending = 0
+        self._last_flush = time.time()
 
     def __str__(self):
         return "GraphiteSubmitter: %s" % str( [(host, port) for (host, port, _) in self.hosts] )
 
+    @property
+    def dropped(self):
+        """How many metrics have been dropped because a queue was full"""
+        return sum(h.dropped for h in self._hosts)
+
+    def submit(self, name, value, timestamp=None):
+        if not timestamp:
+            timestamp = int(time.time())
+
+        for h in self._hosts:
+            h.put(name, value, timestamp)
+        self._pending += 1
+        if self._pending >= self.batch_size or time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Sends whatever is queued to the hosts that are up. Returns True if
+        nothing is left queued."""
+        now = time.time()
+        self._last_flush = now
+        self._pending = 0
+        done = True
+        for h in self._hosts:
+            while h.queue and h.connect(now):
+                batch = [h.queue[i] for i in xrange(min(self.batch_size, len(h.queue)))]
+                try:
+                    h.sock.sendall(self._format(batch))
+                except (socket.error, socket.timeout), e:
+                    h.failed(now, e)
+                    break
+                for _ in batch:
+                    h.queue.popleft()
+                h.sent += len(batch)
+                h.backoff = 0
+            if h.queue:
+                done = False
+        return done
+
+    def wait(self, timeout=30):
+        """Flushes everything, retrying hosts that are down for up to timeout
+        seconds, and disconnects"""
+        deadline = time.time() + timeout
+        while not self.flush():
+            next_attempt = min(h.next_attempt for h in self._hosts if h.queue)
+            if next_attempt >= deadline:
+                break
+            time.sleep(max(next_attempt - time.time(), 0))
+
+        for h in self._hosts:
+            if h.queue:
+                log.error("%s: gave up on %i metrics", h, len(h.queue))
+            if h.dropped:
+                log.error("%s: dropped %i metrics because the queue was full", h, h.dropped)
+            log.debug("%s: sent %i metrics", h, h.sent)
+            h.queue.clear()
+        self.disconnect()
+
+    def disconnect(self):
+        for h in self._hosts:
+            h.close()
+
+
+class SpoolingSubmitter(object):
+    """
+    Writes metrics to an append-only spool file in spool_dir, and sends them
+    with submitter from a background thread.
+
+    The spool holds unprefixed "name value timestamp" lines, and spool.offset
+    how much of it has been sent to every host. Only one process sends from a
+    spool at a time; the others just append to it. Metrics may be sent more
+    than once after a failure, which graphite doesn't mind.
+    """
+    def __init__(self, submitter, spool_dir, interval=1, read_size=64 * 1024):
+        self.submitter = submitter
+        self.interval = interval
+        self.read_size = read_size
+        if not os.path.exists(spool_dir):
+            try:
+                os.makedirs(spool_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.spool_path = os.path.join(spool_dir, 'spool')
+        self.offset_path = os.path.join(spool_dir, 'spool.offset')
+        # Lines are written whole under an flock, through an unbuffered
+        # O_APPEND fd, so writers can't interleave with each other or with
+        # _truncate
+        self._spool = os.open(self.spool_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._pending = []
+        self._pending_size = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closing = False
+
+        self._sender_lock = open(os.path.join(spool_dir, 'sender.lock'), 'w')
+        self._thread = None
+        if self._become_sender():
+            self._start()
+
+    def __str__(self):
+        return "SpoolingSubmitter: %s via %s" % (self.submitter, self.spool_path)
+
+    def _become_sender(self):
+        try:
+            fcntl.flock(self._sender_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="graphite-sender")
+        self._thread.daemon = True
+        self._thread.start()
+
     def submit(self, name, value, timestamp=None):
         if not timestamp:
             timestamp = int(time.time())
+        line = "%s %s %i\n" % (name, value, timestamp)
+        with self._lock:
+            self._pending.append(line)
+            self._pending_size += len(line)
+            if self._pending_size >= self.read_size:
+                self._write_pending()
+
+    def _write_pending(self):
+        """Appends the pending lines to the spool. Must be called with
+        self._lock held."""
+        if not self._pending:
+            return
+        data = ''.join(self._pending)
+        fcntl.flock(self._spool, fcntl.LOCK_EX)
+        try:
+            while data:
+                data = data[os.write(self._spool, data):]
+        finally:
+            fcntl.flock(self._spool, fcntl.LOCK_UN)
+        self._pending = []
+        self._pending_size = 0
+
+    def _write_spool(self):
+        """Appends what's been submitted to the spool file"""
+        with self._lock:
+            self._write_pending()
 
-        for s, prefix in self._socks:
-            line = "%s.%s %s %i\n" % (prefix, name, value, timestamp)
-            s.sendall(line)
+    def _read_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
 
-    def wait(self):
-        for s, _ in self._socks:
-            s.close()
+    def _write_offset(self, offset):
+        atomic_write(self.offset_path, "%i\n" % offset)
+
+    def _send_some(self, f, offset):
+        """Sends metrics from the spool starting at offset. Returns the
+        offset that's been sent up to."""
+        f.seek(offset)
+        data = f.read(self.read_size)
+        # Only whole lines; the rest is still being written
+        end = data.rfind('\n') + 1
+        if not end:
+            return offset
+        for line in data[:end].splitlines():
+            try:
+                name, value, timestamp = line.split()
+                self.submitter.submit(name, value, int(timestamp))
+            except ValueError:
+                log.warn("ignoring bad line in %s: %r", self.spool_path, line)
+        while not self.submitter.flush():
+            # Keep what we've read queued, and try again later. If we exit
+            # first, the next sender will read it again.
+            if self._closing:
+                return offset
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+        offset += end
+        self._write_offset(offset)
+        return offset
+
+    def _truncate(self, offset):
+        """Empties the spool if everything in it has been sent"""
+        with self._lock:
+            self._write_pending()
+            fcntl.flock(self._spool, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._spool).st_size != offset:
+                    return offset
+                os.ftruncate(self._spool, 0)
+                self._write_offset(0)
+                return 0
+            finally:
+                fcntl.flock(self._spool, fcntl.LOCK_UN)
+
+    def _run(self):
+        offset = self._read_offset()
+        with open(self.spool_path, 'rb') as f:
+            while True:
+                # Once we're closing, make one last pass over everything
+                # that's been submitted
+                closing = self._closing
+                self._write_spool()
+                size = os.fstat(f.fileno()).st_size
+                if offset > size:
+                    # Someone else truncated it
+                    offset = 0
+                try:
+                    while offset < size:
+                        new_offset = self._send_some(f, offset)
+                        if new_offset == offset:
+                            break
+                        offset = new_offset
+                    if offset and offset == size:
+                        offset = self._truncate(offset)
+                except Exception:
+                    log.exception("error sending metrics from %s", self.spool_path)
+                if closing:
+                    return
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+
+    def wait(self, timeout=30):
+        """Sends what we can in timeout seconds, and stops the sender. Metrics
+        that couldn't be sent stay in the spool."""
+        if self._closing:
+            return
+        self._write_spool()
+        if self._thread is None and self._become_sender():
+            # Whoever was sending has gone, so pick up after them
+            self._start()
+        self._closing = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                log.warn("metrics are still being sent; the rest will be sent next time")
+                return
+        self.submitter.disconnect()
+        os.close(self._spool)
 
 
 def graphite_from_config():
@@ -46,8 +381,20 @@ def graphite_from_config():
         port = int(port)
         hosts.append((host, port, prefix))
 
-    g = GraphiteSubmitter(hosts)
-    # Make sure we sleep to let metrics get through. cf.
-    # https://bugzilla.mozilla.org/show_bug.cgi?id=1025145
-    time.sleep(1)
+    def option(name, default, type=str):
+        if config.has_option('graphite', name):
+            return type(config.get('graphite', name))
+        return default
+
+    g = GraphiteSubmitter(hosts,
+                          protocol=option('protocol', 'plaintext'),
+                          batch_size=option('batch_size', 500, int),
+                          flush_interval=option('flush_interval', 10, float),
+                          max_queue=option('max_queue', 100000, int),
+                          connect_delay=option('connect_delay', 1, float))
+    if option('spool', 'true').lower() in ('true', 'yes', 'on', '1'):
+        spool_dir = option('spool_dir', os.path.expanduser('~/.reportor/graphite'))
+        g = SpoolingSubmitter(g, spool_dir)
+    # Reports don't always call wait(), so make sure nothing is left behind
+    atexit.register(g.wait)
     return g
@@ -0,0 +1,148 @@
+"""
+Records every run of every report: how long it took, the resources it used
+and how it exited. This is used to make better scheduling decisions and to
+find the reports that are slowing us down.
+"""
+import os
+import sqlite3
+import logging
+
+from reportor.utils import median, percentile
+
+log = logging.getLogger(__name__)
+
+# Columns of the runs table, besides the id
+COLUMNS = [
+    ('name', 'TEXT NOT NULL'),
+    ('start_time', 'REAL NOT NULL'),
+    ('end_time', 'REAL NOT NULL'),
+    ('returncode', 'INTEGER'),
+    ('user_time', 'REAL'),
+    ('sys_time', 'REAL'),
+    # NULL when the report's peak RSS was no higher than reportor's when it
+    # started the report, since then it's reportor's that was reported
+    ('max_rss', 'INTEGER'),
+    ('bytes_written', 'INTEGER'),
+    ('killed', 'INTEGER NOT NULL DEFAULT 0'),
+    # Runs that couldn't be started have no returncode
+    ('failed_to_start', 'INTEGER NOT NULL DEFAULT 0'),
+]
+
+
+class RunHistory(object):
+    # How many recent runs to consider when estimating a report's runtime
+    estimate_window = 10
+    # How many recent runs to consider for automatic maxtimes, and how many
+    # we need before we trust them
+    maxtime_window = 100
+    maxtime_min_runs = 5
+
+    def __init__(self, path):
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, %s)" %
+                        ", ".join("%s %s" % c for c in COLUMNS))
+        # Add any columns that older databases are missing
+        existing = set(row[1] for row in self.db.execute("PRAGMA table_info(runs)"))
+        for column, type_ in COLUMNS:
+            if column not in existing:
+                self.db.execute("ALTER TABLE runs ADD COLUMN %s %s" % (column, type_))
+        self.db.execute("CREATE INDEX IF NOT EXISTS runs_name_start ON runs (name, start_time)")
+        self.db.commit()
+
+    def record(self, run):
+        """Records a finished ReportRun"""
+        log.debug("%s: recording run", run.name)
+        row = {
+            'name': run.name,
+            'start_time': run.start_time,
+            'end_time': run.end_time,
+            'returncode': run.returncode,
+            'bytes_written': run.bytes_written,
+            'killed': int(run.killed),
+            'failed_to_start': int(run.failed_to_start),
+        }
+        if run.rusage:
+            row['user_time'] = run.rusage.ru_utime
+            row['sys_time'] = run.rusage.ru_stime
+            if run.inherited_max_rss is None or run.rusage.ru_maxrss > run.inherited_max_rss:
+                # ru_maxrss is in kilobytes
+                row['max_rss'] = run.rusage.ru_maxrss * 1024
+        self.db.execute("INSERT INTO runs (%s) VALUES (%s)" % (", ".join(row), ", ".join("?" * len(row))),
+                        row.values())
+        self.db.commit()
+
+    def durations(self, name, limit=None, since=None):
+        """Returns the durations of the most recent successful runs of report
+        `name`, newest first"""
+        q = "SELECT end_time - start_time FROM runs WHERE name = ? AND returncode = 0"
+        args = (name,)
+        if since:
+            q += " AND start_time >= ?"
+            args += (since,)
+        q += " ORDER BY start_time DESC"
+        if limit:
+            q += " LIMIT ?"
+            args += (limit,)
+        return [row[0] for row in self.db.execute(q, args)]
+
+    def estimate(self, name):
+        """Returns the expected runtime of report `name`, or None if it
+        hasn't run successfully before"""
+        durations = self.durations(name, self.estimate_window)
+        if not durations:
+            return None
+        return median(durations)
+
+    def auto_maxtime(self, name, factor):
+        """Returns a maxtime for report `name` based on the 99th percentile
+        of its recent runtimes, or None if it hasn't run enough times"""
+        durations = self.durations(name, self.maxtime_window)
+        if len(durations) < self.maxtime_min_runs:
+            return None
+        return percentile(durations, 99) * factor
+
+    def names(self):
+        return [row[0] for row in self.db.execute("SELECT DISTINCT name FROM runs ORDER BY name")]
+
+    def stats(self, name, since=None):
+        """Returns a dict of summary statistics for report `name`'s runs
+        since `since` (an epoch timestamp)"""
+        q = ("SELECT COUNT(*), SUM(returncode != 0 OR failed_to_start), SUM(killed), MAX(max_rss), "
+             "AVG(user_time + sys_time), AVG(bytes_written) FROM runs WHERE name = ?")
+        args = (name,)
+        if since:
+            q += " AND start_time >= ?"
+            args += (since,)
+        runs, failures, killed, max_rss, cpu, bytes_written = self.db.execute(q, args).fetchone()
+
+        durations = self.durations(name, since=since)
+        retval = {
+            'runs': runs,
+            'failures': failures or 0,
+            'killed': killed or 0,
+            'max_rss': max_rss,
+            'cpu': cpu,
+            'bytes_written': bytes_written,
+            'p50': None,
+            'p95': None,
+            'last': None,
+            'trend': None,
+        }
+        if durations:
+            retval['p50'] = percentile(durations, 50)
+            retval['p95'] = percentile(durations, 95)
+            retval['last'] = durations[0]
+            # Compare the most recent half of the runs with the older half
+            half = len(durations) // 2
+            if half:
+                old = median(durations[half:])
+                if old:
+                    retval['trend'] = (median(durations[:half]) - old) / old
+        return retval
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,205 @@
+"""
+HTTP helpers for reports
+
+All requests go through one shared requests.Session, so connections to the
+same host are kept alive and reused, and failed requests are retried with
+backoff. fetch_many() fetches several URLs at once, and HTTPCache keeps
+responses on disk, revalidating them with ETag/Last-Modified once they're
+older than its ttl, so unchanged documents aren't downloaded every run.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    from urllib3.util.retry import Retry
+
+from reportor.utils import atomic_write
+
+log = logging.getLogger(__name__)
+
+# How many connections to keep open to each host
+POOL_SIZE = 16
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+TIMEOUT = 60
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    """Returns the shared Session"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            s = requests.Session()
+            retry = Retry(total=RETRIES, backoff_factor=BACKOFF_FACTOR,
+                          status_forcelist=(500, 502, 503, 504))
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            _session = s
+        return _session
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    return session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def head(url, **kwargs):
+    kwargs.setdefault('allow_redirects', True)
+    return request('HEAD', url, **kwargs)
+
+
+def get_json(url, **kwargs):
+    response = get(url, **kwargs)
+    response.raise_for_status()
+    return response.json()
+
+
+def pmap(func, items, threads=8):
+    """Returns [func(item) for item in items], calling func from a pool of
+    threads. The first exception raised by func is re-raised."""
+    items = list(items)
+    if len(items) <= 1 or threads <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(threads, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def fetch_many(urls, fetch=get, threads=8):
+    """Fetches urls concurrently with fetch, returning the responses in the
+    same order"""
+    return pmap(fetch, urls, threads)
+
+
+def default_cache_dir():
+    return os.environ.get('REPORTOR_HTTP_CACHE', os.path.expanduser('~/.reportor/http'))
+
+
+class CachedResponse(object):
+    """Enough of requests.Response for reading a cached body"""
+    def __init__(self, url, status_code, headers, content, from_cache):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+
+class HTTPCache(object):
+    """
+    Caches GET responses in path.
+
+    Responses younger than ttl seconds are used without asking the server.
+    Older ones are revalidated with If-None-Match/If-Modified-Since, and only
+    downloaded again if they've changed.
+    """
+    def __init__(self, path=None, ttl=0):
+        self.path = path or default_cache_dir()
+        self.ttl = ttl
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+
+    def _paths(self, url):
+        key = hashlib.sha1(url).hexdigest()
+        base = os.path.join(self.path, key[:2], key)
+        return base + '.meta', base + '.body'
+
+    def _load(self, url):
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get('url') != url:
+                return None, None
+            with open(body_path, 'rb') as f:
+                return meta, f.read()
+        except (IOError, ValueError):
+            return None, None
+
+    def _write(self, path, data):
+        d = os.path.dirname(path)
+        if not os.path.exists(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                if not os.path.isdir(d):
+                    raise
+        atomic_write(path, data)
+
+    def _save(self, url, meta, content=None):
+        meta_path, body_path = self._paths(url)
+        if content is not None:
+            self._write(body_path, content)
+        self._write(meta_path, json.dumps(meta))
+
+    def get(self, url, ttl=None, **kwargs):
+        """Returns a response for url, from the cache if possible"""
+        if ttl is None:
+            ttl = self.ttl
+        meta, content = self._load(url)
+        now = time.time()
+        if meta and now - meta['fetched'] < ttl:
+            log.debug("%s: cached", url)
+            return CachedResponse(url, meta['status_code'], meta['headers'], content, True)
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if meta:
+            if meta['headers'].get('etag'):
+                headers['If-None-Match'] = meta['headers']['etag']
+            if meta['headers'].get('last-modified'):
+                headers['If-Modified-Since'] = meta['headers']['last-modified']
+        response = get(url, headers=headers, **kwargs)
+
+        if meta and response.status_code == 304:
+            log.debug("%s: not modified", url)
+            meta['fetched'] = now
+            self._save(url, meta)
+            return CachedResponse(url, meta['status_code'], meta['headers'], content, True)
+
+        response.raise_for_status()
+        response.from_cache = False
+        self._save(url, {
+            'url': url,
+            'fetched': now,
+            'status_code': response.status_code,
+            'headers': dict((k.lower(), v) for k, v in response.headers.items()),
+        }, response.content)
+        return response
+
+    def get_json(self, url, ttl=None, **kwargs):
+        return self.get(url, ttl, **kwargs).json()
@@ -0,0 +1,199 @@
+"""
+Skip reports whose inputs haven't changed since they last ran
+
+Reports opt in with a `cache` section that declares their inputs:
+
+report2:
+    command: python report2.py
+    requires: [report1]
+    cache:
+        files: ["*.py", "data/*.json"]
+        env: [REPORT2_MODE]
+
+The cache key covers the command, the contents of `files` (globs relative to
+the report's cwd), the values of the `env` variables and the output of every
+report in `requires`. If the key matches the report's last successful run
+and that run's output is still around, the output is hardlinked into place
+instead of running the report. Since a skipped report's output is identical
+to the previous one, its cached dependents get skipped too.
+"""
+import os
+import glob
+import json
+import shutil
+import hashlib
+import logging
+
+from reportor.utils import atomic_write_json
+
+log = logging.getLogger(__name__)
+
+
+def hash_file(path, h=None):
+    if h is None:
+        h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            h.update(block)
+    return h
+
+
+def hash_tree(path, exclude=()):
+    """Returns a digest of the names and contents of all files under path"""
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            filename = os.path.join(root, f)
+            if filename in exclude:
+                continue
+            h.update(os.path.relpath(filename, path).encode('utf8') + b'\0')
+            hash_file(filename, h)
+            h.update(b'\0')
+    return h.hexdigest()
+
+
+def link_tree(src, dst):
+    """Hardlinks all the files under src into dst, copying them if they can't
+    be linked"""
+    for root, dirs, files in os.walk(src):
+        dst_root = os.path.join(dst, os.path.relpath(root, src))
+        if not os.path.exists(dst_root):
+            os.makedirs(dst_root)
+        for f in files:
+            src_name = os.path.join(root, f)
+            dst_name = os.path.join(dst_root, f)
+            if os.path.lexists(dst_name):
+                os.unlink(dst_name)
+            try:
+                os.link(src_name, dst_name)
+            except OSError:
+                shutil.copy2(src_name, dst_name)
+
+
+class IncrementalState(object):
+    """
+    Keeps track of the cache keys of reports' last successful runs
+    """
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+
+    def _state_path(self, name):
+        return os.path.join(self.state_dir, '%s.json' % name)
+
+    def load(self, name):
+        try:
+            with open(self._state_path(name)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save(self, name, state):
+        atomic_write_json(self._state_path(name), state)
+
+    def forget(self, name):
+        if os.path.exists(self._state_path(name)):
+            os.unlink(self._state_path(name))
+
+    def batch(self):
+        """Returns an IncrementalBatch for a new batch of reports"""
+        return IncrementalBatch(self)
+
+
+class IncrementalBatch(object):
+    """
+    Works out the cache keys of the reports in one batch, from the output of
+    the reports that have finished in it. `reportor serve` runs many batches,
+    so each gets its own; a report's output from an earlier batch says
+    nothing about what its dependents will see in this one.
+    """
+    def __init__(self, state):
+        self.state = state
+        self.finished = {}
+        self._digests = {}
+
+    def output_digest(self, name):
+        """Returns a digest of the output of report `name` from this batch"""
+        if name not in self._digests:
+            run = self.finished.get(name)
+            if run is None:
+                return None
+            self._digests[name] = hash_tree(run.output_dir, exclude=run.log_files())
+        return self._digests[name]
+
+    def cache_key(self, run):
+        """Returns the cache key for a ReportRun, or None if the report isn't
+        cacheable"""
+        cache = run.config.get('cache')
+        if not cache:
+            return None
+        if cache is True:
+            cache = {}
+
+        h = hashlib.sha1()
+        h.update(json.dumps(run.config.get('command')).encode('utf8'))
+
+        h.update(b'\0files\0')
+        filenames = set()
+        for pat in cache.get('files', []):
+            filenames.update(glob.glob(os.path.join(run.cwd, pat)))
+        for filename in sorted(filenames):
+            if not os.path.isfile(filename):
+                continue
+            h.update(os.path.relpath(filename, run.cwd).encode('utf8') + b'\0')
+            hash_file(filename, h)
+
+        h.update(b'\0env\0')
+        for var in sorted(cache.get('env', [])):
+            h.update(json.dumps([var, run.env.get(var)]).encode('utf8'))
+
+        h.update(b'\0requires\0')
+        for req in sorted(run.config.get('requires', [])):
+            digest = self.output_digest(req)
+            if digest is None:
+                log.debug("%s: don't know what %s produced", run.name, req)
+                return None
+            h.update(('%s %s\n' % (req, digest)).encode('utf8'))
+        return h.hexdigest()
+
+    def reuse(self, run, key):
+        """Puts the output of the last run of `run` with the same cache key
+        into place. Returns True if it did so."""
+        state = self.state.load(run.name)
+        if not state or state.get('key') != key:
+            return False
+        previous = state['output_dir']
+        if previous == run.publish_dir or not os.path.isdir(previous):
+            return False
+        log.info("%s: inputs unchanged; reusing output from %s", run.name, previous)
+        link_tree(previous, run.output_dir)
+        self._digests[run.name] = state['digest']
+        # Point at the newest copy, so older output directories can be
+        # cleaned up
+        state['output_dir'] = run.publish_dir
+        self.state.save(run.name, state)
+        return True
+
+    def finish(self, run):
+        """Called once `run` has finished"""
+        self.finished[run.name] = run
+        if run.cached:
+            # reuse() already knows the digest
+            return
+        # Whatever was hashed before is out of date now
+        self._digests.pop(run.name, None)
+        if run.cache_key is None:
+            return
+        if run.returncode != 0:
+            self.state.forget(run.name)
+            return
+        self.state.save(run.name, {
+            'key': run.cache_key,
+            'output_dir': run.publish_dir,
+            'digest': self.output_digest(run.name),
+        })
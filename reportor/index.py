@@ -0,0 +1,198 @@
+"""
+An index of the output of every report run
+
+Each run is recorded as it finishes: the report's name, the time it was run
+for, where its output is, whether it succeeded, and the files it wrote. This
+answers "where is the last good output of report X?" without scanning the
+dated output directories. Reports are told where their own previous output
+is in REPORTOR_PREVIOUS_OUTPUT, and can look up other reports' with
+previous_output(). `reportor ls` lists runs from the index.
+
+Runs from before the index existed can be added with scan().
+"""
+import os
+import sqlite3
+import logging
+import calendar
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+
+def index_path(state_dir):
+    return os.path.join(state_dir, 'index.sqlite')
+
+
+def list_files(path):
+    """Returns (relative path, size) for every file under path"""
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for f in sorted(names):
+            filename = os.path.join(root, f)
+            files.append((os.path.relpath(filename, path), os.lstat(filename).st_size))
+    return files
+
+
+class RunIndex(object):
+    def __init__(self, path):
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # Reports read the index while we're writing it
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("""CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            run_time INTEGER NOT NULL,
+            output_dir TEXT NOT NULL UNIQUE,
+            status TEXT NOT NULL,
+            returncode INTEGER,
+            cached INTEGER NOT NULL DEFAULT 0,
+            start_time REAL,
+            end_time REAL,
+            size INTEGER)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+            run_id INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS runs_name_status_time ON runs (name, status, run_time)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS runs_time ON runs (run_time)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_run ON files (run_id)")
+        self.db.commit()
+
+    def _add(self, row, files):
+        """Adds a run, replacing whatever was recorded for its output
+        directory before"""
+        for (run_id,) in self.db.execute("SELECT id FROM runs WHERE output_dir = ?", (row['output_dir'],)):
+            self.db.execute("DELETE FROM files WHERE run_id = ?", (run_id,))
+            self.db.execute("DELETE FROM runs WHERE id = ?", (run_id,))
+        row['size'] = sum(size for _, size in files)
+        cur = self.db.execute("INSERT INTO runs (%s) VALUES (%s)" % (", ".join(row), ", ".join("?" * len(row))),
+                              row.values())
+        self.db.executemany("INSERT INTO files (run_id, path, size) VALUES (?, ?, ?)",
+                            [(cur.lastrowid, path, size) for path, size in files])
+
+    def record(self, run):
+        """Records a finished ReportRun"""
+        log.debug("%s: indexing %s", run.name, run.output_dir)
+        self._add({
+            'name': run.name,
+            'run_time': calendar.timegm(run.now.utctimetuple()),
+            'output_dir': os.path.abspath(run.output_dir),
+            'status': 'ok' if run.succeeded else 'failed',
+            'returncode': run.returncode,
+            'cached': int(run.cached),
+            'start_time': run.start_time,
+            'end_time': run.end_time,
+        }, list_files(run.output_dir))
+        self.db.commit()
+
+    def runs(self, name=None, since=None, until=None, status=None, limit=None):
+        """Returns the runs matching the arguments, newest first. since and
+        until are epoch timestamps of the time reports were run for."""
+        q = "SELECT * FROM runs WHERE 1"
+        args = ()
+        if name:
+            q += " AND name = ?"
+            args += (name,)
+        if status:
+            q += " AND status = ?"
+            args += (status,)
+        if since is not None:
+            q += " AND run_time >= ?"
+            args += (since,)
+        if until is not None:
+            q += " AND run_time < ?"
+            args += (until,)
+        q += " ORDER BY run_time DESC, name"
+        if limit:
+            q += " LIMIT ?"
+            args += (limit,)
+        return self.db.execute(q, args).fetchall()
+
+    def previous(self, name, before=None, status='ok'):
+        """Returns the newest run of report `name` from before `before` whose
+        output is still around, or None"""
+        q = "SELECT * FROM runs WHERE name = ? AND status = ?"
+        args = (name, status)
+        if before is not None:
+            q += " AND run_time < ?"
+            args += (before,)
+        q += " ORDER BY run_time DESC"
+        for row in self.db.execute(q, args):
+            if os.path.isdir(row['output_dir']):
+                return row
+            log.debug("%s: %s is gone", name, row['output_dir'])
+        return None
+
+    def files(self, run_id):
+        """Returns (path, size) for the files of a run"""
+        return [tuple(row) for row in
+                self.db.execute("SELECT path, size FROM files WHERE run_id = ? ORDER BY path", (run_id,))]
+
+    def names(self):
+        return [row[0] for row in self.db.execute("SELECT DISTINCT name FROM runs ORDER BY name")]
+
+    def scan(self, output_dir):
+        """Adds runs from the dated directories matching the output_dir
+        pattern that aren't in the index yet. Returns how many were added."""
+        parts = output_dir.split(os.sep)
+        for i, part in enumerate(parts):
+            if '%' in part:
+                break
+        else:
+            i = len(parts)
+        prefix = os.sep.join(parts[:i]) or os.curdir
+        pattern = os.sep.join(parts[i:])
+        known = set(row[0] for row in self.db.execute("SELECT output_dir FROM runs"))
+
+        added = 0
+        for root, dirs, _ in os.walk(prefix):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            rel = os.path.relpath(root, prefix)
+            depth = 0 if rel == os.curdir else rel.count(os.sep) + 1
+            if depth < len(parts) - i:
+                continue
+            dirs[:] = []
+            try:
+                run_time = calendar.timegm(datetime.strptime(rel, pattern).utctimetuple())
+            except ValueError:
+                continue
+            outputs = [(d, 'ok', os.path.join(root, d)) for d in os.listdir(root)
+                       if not d.startswith('.')]
+            failed_dir = os.path.join(root, '.failed')
+            if os.path.isdir(failed_dir):
+                outputs += [(d, 'failed', os.path.join(failed_dir, d)) for d in os.listdir(failed_dir)]
+            for name, status, path in outputs:
+                path = os.path.abspath(path)
+                if path in known or not os.path.isdir(path):
+                    continue
+                self._add({
+                    'name': name,
+                    'run_time': run_time,
+                    'output_dir': path,
+                    'status': status,
+                }, list_files(path))
+                added += 1
+        self.db.commit()
+        return added
+
+    def close(self):
+        self.db.close()
+
+
+def previous_output(name=None):
+    """Returns the output directory of the last successful run of report
+    `name` (by default, the running report) from before this run, or None"""
+    name = name or os.environ['REPORTOR_NAME']
+    if name == os.environ.get('REPORTOR_NAME'):
+        return os.environ.get('REPORTOR_PREVIOUS_OUTPUT')
+    index = RunIndex(index_path(os.environ['REPORTOR_STATE_DIR']))
+    try:
+        row = index.previous(name, before=int(os.environ['REPORTOR_NOW']))
+        return row['output_dir'] if row else None
+    finally:
+        index.close()
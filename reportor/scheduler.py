@@ -0,0 +1,379 @@
+"""
+Event driven scheduling of report runs
+
+Reports are started as soon as their requirements have finished, enough
+units of their locks are free, and there are enough free job slots. Instead
+of polling every running report, the scheduler sleeps until a child exits
+(SIGCHLD) or the next maxtime deadline passes, and then only looks at the
+reports affected by that event.
+
+When more reports are ready than can be started, the ones with the longest
+expected path through their dependents (the critical path) go first.
+"""
+import os
+import time
+import heapq
+import errno
+import itertools
+import fcntl
+import signal
+import select
+import logging
+from collections import defaultdict, Counter
+
+from reportor.utils import avg
+
+log = logging.getLogger(__name__)
+
+
+def exitstatus_to_returncode(status):
+    """Converts a status as returned by os.waitpid into a Popen-style
+    returncode"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class Batch(object):
+    """The reports from a single call to Scheduler.submit"""
+    def __init__(self, on_done):
+        self.on_done = on_done
+        self.remaining = 0
+
+
+class Job(object):
+    """A single report within a submitted manifest"""
+    run = None
+
+    def __init__(self, name, config, make_run, batch):
+        self.name = name
+        self.config = config
+        self.make_run = make_run
+        self.batch = batch
+        locks = config.get('locks', [])
+        if hasattr(locks, 'items'):
+            self.locks = dict(locks)
+        else:
+            self.locks = dict((lock, 1) for lock in locks)
+        # Never run two copies of the same report at once
+        self.locks['report:%s' % name] = 1
+        self.slots = config.get('slots', 1)
+        self.dependents = []
+        self.waiting = 0
+        self.state = 'pending'
+        # Expected time from starting this report until all of its
+        # dependents have finished
+        self.priority = 0
+
+
+class Scheduler(object):
+    """
+    Runs manifests' reports.
+
+    jobs is the number of job slots available, or None for no limit.
+    resources maps lock names to their capacities; locks not listed have a
+    capacity of 1.
+    estimate(name) returns the expected runtime of a report in seconds, or
+    None if it isn't known.
+    """
+    def __init__(self, jobs=None, resources=None, estimate=None):
+        self.jobs = jobs
+        self.resources = dict(resources or {})
+        self.estimate = estimate
+        self._ready = []
+        self._seq = itertools.count()
+        self._running = {}
+        self._deadlines = []
+        self._used_slots = 0
+        self._used_locks = Counter()
+        self._lock_waiters = defaultdict(list)
+
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def submit(self, m, make_run, on_done=None):
+        """Adds the reports in manifest m to the scheduler.
+
+        make_run(name, config) is called to create the ReportRun for each
+        report once it is ready to start. on_done() is called once all the
+        reports that can run have finished.
+        """
+        batch = Batch(on_done)
+        jobs = {}
+        for name, config in m.items():
+            jobs[name] = Job(name, config, make_run, batch)
+
+        for name, config in m.items():
+            job = jobs[name]
+            for req in config.get('requires', []):
+                if req not in jobs:
+                    log.error("%s requires %s, which isn't being run; it will never start", name, req)
+                    job.waiting += 1
+                    continue
+                jobs[req].dependents.append(job)
+                job.waiting += 1
+
+        for name, config in m.items():
+            job = jobs[name]
+            # Make sure the report can run at all
+            if self.jobs is not None and job.slots > self.jobs:
+                log.warn("%s wants %i slots; limiting it to %i", name, job.slots, self.jobs)
+                job.slots = self.jobs
+            for lock, amount in job.locks.items():
+                if amount > self.capacity(lock):
+                    log.warn("%s wants %i of %s; limiting it to %i", name, amount, lock, self.capacity(lock))
+                    job.locks[lock] = self.capacity(lock)
+
+        self._prioritize(jobs)
+
+        runnable = self._runnable(jobs)
+        for name, config in m.items():
+            if name not in runnable:
+                log.error("%s: will never start", name)
+        batch.remaining = len(runnable)
+        if not batch.remaining and on_done:
+            on_done()
+
+        for name, config in m.items():
+            job = jobs[name]
+            if job.waiting == 0:
+                self._make_ready(job)
+            elif name in runnable:
+                log.debug("%s is waiting for reports %s", name, config['requires'])
+
+    def _runnable(self, jobs):
+        """Returns the names of the jobs whose requirements can all be met"""
+        waiting = dict((name, job.waiting) for name, job in jobs.items())
+        ready = [job for job in jobs.values() if job.waiting == 0]
+        runnable = set()
+        while ready:
+            job = ready.pop()
+            runnable.add(job.name)
+            for d in job.dependents:
+                waiting[d.name] -= 1
+                if waiting[d.name] == 0:
+                    ready.append(d)
+        return runnable
+
+    def _prioritize(self, jobs):
+        """Sets each job's priority to the expected length of the longest
+        path from it through its dependents"""
+        estimates = {}
+        if self.estimate:
+            for name in jobs:
+                estimates[name] = self.estimate(name)
+        known = [e for e in estimates.values() if e is not None]
+        if known:
+            default = avg(known)
+        else:
+            default = 1
+
+        def prioritize(job, visiting):
+            if job.name in done:
+                return job.priority
+            if job.name in visiting:
+                # Dependency cycle; these reports will never start anyway
+                return 0
+            visiting.add(job.name)
+            downstream = [prioritize(d, visiting) for d in job.dependents]
+            visiting.discard(job.name)
+
+            estimate = estimates.get(job.name)
+            if estimate is None:
+                estimate = default
+            job.priority = estimate + max(downstream or [0])
+            done.add(job.name)
+            return job.priority
+
+        done = set()
+        for job in jobs.values():
+            prioritize(job, set())
+
+    def _make_ready(self, job):
+        heapq.heappush(self._ready, (-job.priority, next(self._seq), job))
+
+    def capacity(self, lock):
+        return self.resources.get(lock, 1)
+
+    @property
+    def free_slots(self):
+        if self.jobs is None:
+            return None
+        return self.jobs - self._used_slots
+
+    @property
+    def busy(self):
+        return bool(self._ready or self._running)
+
+    def run(self):
+        """Runs until everything submitted has finished"""
+        with self.handling_signals():
+            while self.busy:
+                self.step()
+
+    def handling_signals(self):
+        return _SigchldHandler(self._wakeup_w)
+
+    def step(self, timeout=None):
+        """Starts whatever is ready, and then waits for at most `timeout`
+        seconds for a child to exit or a deadline to pass"""
+        self._start_ready()
+        if not self._running and timeout is None:
+            return
+
+        deadline = self._next_deadline()
+        if deadline is not None:
+            until_deadline = max(0, deadline - time.time())
+            if timeout is None or until_deadline < timeout:
+                timeout = until_deadline
+
+        self._wait_for_event(timeout)
+        self._reap()
+        self._check_deadlines()
+
+    def _start_ready(self):
+        # Reports that don't fit into the free slots stay ready, in order
+        too_big = []
+        while self._ready and self.free_slots != 0:
+            item = heapq.heappop(self._ready)
+            job = item[-1]
+            if self.free_slots is not None and job.slots > self.free_slots:
+                log.debug("%s is waiting for %i slots", job.name, job.slots)
+                too_big.append(item)
+                continue
+            self._try_start(job)
+        for item in too_big:
+            heapq.heappush(self._ready, item)
+
+    def _try_start(self, job):
+        for lock, amount in job.locks.items():
+            if self._used_locks[lock] + amount > self.capacity(lock):
+                log.debug("%s is still waiting for lock %s", job.name, lock)
+                self._lock_waiters[lock].append(job)
+                return
+
+        log.info("%s: starting", job.name)
+        job.state = 'running'
+        self._used_locks.update(job.locks)
+        self._used_slots += job.slots
+        try:
+            job.run = job.make_run(job.name, job.config)
+            job.run.start()
+        except Exception:
+            log.exception("%s: couldn't start", job.name)
+            if job.run and job.run.pid is None:
+                job.run.failed_to_start = True
+                job.run.end_time = time.time()
+
+        if job.run is None or job.run.pid is None:
+            # Nothing to wait for
+            self._finish(job)
+            return
+
+        self._running[job.run.pid] = job
+        heapq.heappush(self._deadlines, (job.run.start_time + job.run.maxtime, job.run.pid, job))
+
+    def _wait_for_event(self, timeout):
+        try:
+            select.select([self._wakeup_r], [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+        # Drain the wakeup pipe
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _reap(self):
+        while self._running:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            job = self._running.pop(pid, None)
+            if job is None:
+                log.debug("reaped unknown child %i", pid)
+                continue
+            job.run.reaped(status, rusage)
+            self._finish(job)
+
+    def _finish(self, job):
+        run = job.run
+        job.state = 'finished'
+        if run:
+            # A report going wrong mustn't take down the other reports, or a
+            # long running scheduler
+            try:
+                run.wait()
+            except Exception:
+                log.exception("%s: error finishing", job.name)
+            if run.start_time and run.end_time:
+                log.info("%s: finished (%is elapsed)", job.name, run.end_time - run.start_time)
+
+        self._used_slots -= job.slots
+        self._used_locks.subtract(job.locks)
+        for lock in job.locks:
+            for waiter in self._lock_waiters.pop(lock, []):
+                self._make_ready(waiter)
+
+        for dependent in job.dependents:
+            dependent.waiting -= 1
+            if dependent.waiting == 0:
+                self._make_ready(dependent)
+
+        job.batch.remaining -= 1
+        if job.batch.remaining == 0 and job.batch.on_done:
+            try:
+                job.batch.on_done()
+            except Exception:
+                log.exception("error finishing a batch")
+
+    def _next_deadline(self):
+        while self._deadlines:
+            deadline, pid, job = self._deadlines[0]
+            if self._running.get(pid) is job:
+                return deadline
+            heapq.heappop(self._deadlines)
+        return None
+
+    def _check_deadlines(self):
+        now = time.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, pid, job = heapq.heappop(self._deadlines)
+            if self._running.get(pid) is not job:
+                continue
+            if not job.run.killed:
+                log.info("killing %s; it's taking too long", job.name)
+                job.run.kill(signal.SIGTERM)
+                heapq.heappush(self._deadlines, (now + job.run.kill_grace, pid, job))
+            else:
+                log.info("killing %s; it didn't exit after SIGTERM", job.name)
+                job.run.kill(signal.SIGKILL)
+
+
+class _SigchldHandler(object):
+    """Context manager that makes SIGCHLD write to the scheduler's wakeup
+    pipe while it's active"""
+    def __init__(self, wakeup_fd):
+        self.wakeup_fd = wakeup_fd
+
+    def __enter__(self):
+        self.old_handler = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.siginterrupt(signal.SIGCHLD, False)
+        self.old_wakeup_fd = signal.set_wakeup_fd(self.wakeup_fd)
+        return self
+
+    def __exit__(self, *exc):
+        signal.set_wakeup_fd(self.old_wakeup_fd)
+        signal.signal(signal.SIGCHLD, self.old_handler)
@@ -0,0 +1,326 @@
+"""
+Time series of values recorded by reports
+
+Reports append samples to named series, instead of leaving them to be parsed
+back out of every dated output directory:
+
+    import reportor.series
+    reportor.series.record('pending.bld-linux64', 42)
+
+Each series is a directory under $REPORTOR_STATE_DIR/series holding one
+append-only file per column: time.bin (little endian int64 timestamps) and
+value.bin (little endian values of the series' dtype), described by
+meta.json. They can be read directly with numpy:
+
+    numpy.memmap('series/pending.bld-linux64/value.bin', dtype='<f8', mode='r')
+
+Samples must be appended in time order, so range queries are a binary search
+and a slice of the memory mapped columns, and nothing is copied until the
+values are used. If numpy is installed, columns can be turned into arrays
+without copying them, and aggregations use it.
+"""
+import os
+import json
+import mmap
+import time
+import errno
+import fcntl
+import struct
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+TIME_DTYPE = '<i8'
+# numpy dtype -> struct format
+DTYPES = {
+    '<f8': '<d',
+    '<f4': '<f',
+    '<i8': '<q',
+    '<i4': '<i',
+    '<u8': '<Q',
+    '<u4': '<I',
+}
+AGGREGATES = ('count', 'sum', 'min', 'max', 'avg', 'first', 'last')
+
+
+def series_dir():
+    """Returns the directory that series are kept in"""
+    if 'REPORTOR_STATE_DIR' in os.environ:
+        return os.path.join(os.environ['REPORTOR_STATE_DIR'], 'series')
+    return os.path.expanduser('~/.reportor/series')
+
+
+class Column(object):
+    """
+    A read-only view of a slice of a column file. Indexing and slicing read
+    straight from the memory map.
+    """
+    def __init__(self, buf, dtype, start, stop):
+        self.buf = buf
+        self.dtype = dtype
+        self.format = DTYPES[dtype]
+        self.itemsize = struct.calcsize(self.format)
+        self.start = start
+        self.stop = max(start, stop)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return self.tolist()[i]
+            return Column(self.buf, self.dtype, self.start + start, self.start + stop)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return struct.unpack_from(self.format, self.buf, (self.start + i) * self.itemsize)[0]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def tolist(self):
+        n = len(self)
+        if not n:
+            return []
+        fmt = '<%i%s' % (n, self.format[1:])
+        return list(struct.unpack_from(fmt, self.buf, self.start * self.itemsize))
+
+    def asarray(self):
+        """Returns the column as a numpy array that shares its memory"""
+        if numpy is None:
+            raise RuntimeError("numpy isn't installed")
+        if not len(self):
+            return numpy.empty(0, dtype=self.dtype)
+        return numpy.frombuffer(self.buf, dtype=self.dtype, count=len(self),
+                                offset=self.start * self.itemsize)
+
+
+def _bisect(col, t, right=False):
+    """Returns where t would go in the sorted column col"""
+    lo, hi = 0, len(col)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        v = col[mid]
+        if v < t or (right and v == t):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _aggregate(func, values):
+    if func == 'count':
+        return len(values)
+    if not len(values):
+        return None
+    if func == 'first':
+        return values[0]
+    if func == 'last':
+        return values[-1]
+    if numpy is not None:
+        a = values.asarray()
+        if func == 'avg':
+            return float(a.mean())
+        return getattr(a, func)().item()
+    values = values.tolist()
+    if func == 'avg':
+        return sum(values) / float(len(values))
+    return {'sum': sum, 'min': min, 'max': max}[func](values)
+
+
+class Series(object):
+    """
+    A time series stored in the directory path. dtype is the numpy dtype of
+    its values; it's only needed when the series is created.
+    """
+    def __init__(self, path, dtype='<f8'):
+        self.path = path
+        self.meta_path = os.path.join(path, 'meta.json')
+        self.time_path = os.path.join(path, 'time.bin')
+        self.value_path = os.path.join(path, 'value.bin')
+        self.dtype = self._init(dtype)
+        self.itemsize = struct.calcsize(DTYPES[self.dtype])
+        self._maps = {}
+
+    def _init(self, dtype):
+        try:
+            with open(self.meta_path) as f:
+                return dict(json.load(f)['columns'])['value']
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        if dtype not in DTYPES:
+            raise ValueError("unsupported dtype %r" % (dtype,))
+        try:
+            os.makedirs(self.path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp = '%s.%i.tmp' % (self.meta_path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'columns': [['time', TIME_DTYPE], ['value', dtype]]}, f)
+        # Whoever creates the series first decides its dtype
+        try:
+            os.link(tmp, self.meta_path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        finally:
+            os.unlink(tmp)
+        with open(self.meta_path) as f:
+            return dict(json.load(f)['columns'])['value']
+
+    def append(self, ts, value):
+        self.extend([(ts, value)])
+
+    def extend(self, samples):
+        """Appends (timestamp, value) pairs, which must be in time order and
+        no older than the last sample"""
+        samples = list(samples)
+        if not samples:
+            return
+        value_fmt = DTYPES[self.dtype]
+        with open(self.time_path, 'ab') as tf:
+            fcntl.flock(tf, fcntl.LOCK_EX)
+            n = tf.tell() // 8
+            last = None
+            if n:
+                with open(self.time_path, 'rb') as f:
+                    f.seek((n - 1) * 8)
+                    last = struct.unpack('<q', f.read(8))[0]
+            times = []
+            values = []
+            for ts, value in samples:
+                ts = int(ts)
+                if last is not None and ts < last:
+                    raise ValueError("%s: sample at %i is older than the last one, at %i"
+                                     % (self.path, ts, last))
+                last = ts
+                times.append(ts)
+                values.append(value)
+            with open(self.value_path, 'ab') as vf:
+                # The time column decides how many samples there are, so drop
+                # values left over from an append that didn't finish
+                vf.truncate(n * self.itemsize)
+                vf.seek(0, os.SEEK_END)
+                vf.write(struct.pack('<%i%s' % (len(values), value_fmt[1:]), *values))
+            tf.write(struct.pack('<%iq' % len(times), *times))
+
+    def _map(self, path):
+        try:
+            size = os.path.getsize(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            size = 0
+        m = self._maps.get(path)
+        if m is None or len(m) != size:
+            if not size:
+                m = ''
+            else:
+                with open(path, 'rb') as f:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[path] = m
+        return m
+
+    def columns(self):
+        """Returns the time and value columns"""
+        t = self._map(self.time_path)
+        v = self._map(self.value_path)
+        n = min(len(t) // 8, len(v) // self.itemsize)
+        return Column(t, TIME_DTYPE, 0, n), Column(v, self.dtype, 0, n)
+
+    def __len__(self):
+        return len(self.columns()[0])
+
+    def range(self, start=None, end=None):
+        """Returns the time and value columns of the samples from start up to
+        (but not including) end"""
+        times, values = self.columns()
+        lo = 0 if start is None else _bisect(times, start)
+        hi = len(times) if end is None else _bisect(times, end)
+        return times[lo:hi], values[lo:hi]
+
+    def last(self):
+        """Returns the last (timestamp, value), or None if there aren't any"""
+        times, values = self.columns()
+        if not len(times):
+            return None
+        return times[-1], values[-1]
+
+    def aggregate(self, func, start=None, end=None, bucket=None):
+        """
+        Aggregates the values from start to end with func (one of
+        AGGREGATES). If bucket is given, returns a list of (bucket start,
+        aggregate) for each bucket of that many seconds that has samples.
+        """
+        if func not in AGGREGATES:
+            raise ValueError("unknown aggregate %r" % (func,))
+        times, values = self.range(start, end)
+        if not bucket:
+            return _aggregate(func, values)
+        result = []
+        i = 0
+        while i < len(times):
+            b = times[i] - times[i] % bucket
+            j = _bisect(times, b + bucket)
+            result.append((b, _aggregate(func, values[i:j])))
+            i = j
+        return result
+
+    def close(self):
+        for m in self._maps.values():
+            if isinstance(m, mmap.mmap):
+                m.close()
+        self._maps = {}
+
+
+def _check_name(name):
+    if not name or name.startswith('.') or os.sep in name:
+        raise ValueError("bad series name %r" % (name,))
+
+
+def open_series(name, dtype='<f8'):
+    """Returns the series called name"""
+    _check_name(name)
+    return Series(os.path.join(series_dir(), name), dtype)
+
+
+def list_series():
+    """Returns the names of all the series"""
+    try:
+        names = os.listdir(series_dir())
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+    return sorted(n for n in names if os.path.exists(os.path.join(series_dir(), n, 'meta.json')))
+
+
+def record(name, value, ts=None, dtype='<f8'):
+    """Appends value to the series called name. The timestamp defaults to
+    the time of the current run.
+
+    Samples older than the last one in the series, e.g. from rerunning a
+    report for an earlier time, are logged and skipped. Returns whether the
+    sample was recorded."""
+    if ts is None:
+        ts = int(os.environ.get('REPORTOR_NOW') or time.time())
+    s = open_series(name, dtype)
+    try:
+        s.append(ts, value)
+        return True
+    except ValueError, e:
+        log.warn("not recording %s: %s", name, e)
+        return False
+    finally:
+        s.close()
@@ -0,0 +1,224 @@
+"""
+Content addressed storage for report output
+
+Most of what reports write into their dated output directories is the same
+from one run to the next: static assets from copy_files, and any output that
+didn't change. Files are kept once in an object store, named by their
+contents, and output directories are made of hardlinks into it.
+
+Files in output directories are shared with older runs, so they must be
+replaced rather than modified in place. To catch anything that tries, the
+store's objects, and so the output files, are read-only. That includes
+output found through REPORTOR_PREVIOUS_OUTPUT. Since that's a constraint on
+reports, reportor only uses the store when it's asked to (--store).
+"""
+import os
+import stat
+import json
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from reportor.copier import copy_contents
+from reportor.utils import atomic_write, atomic_write_json
+
+log = logging.getLogger(__name__)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _make_readonly(path, st):
+    mode = stat.S_IMODE(st.st_mode)
+    if mode & 0o222:
+        os.chmod(path, mode & ~0o222)
+
+
+class ObjectStore(object):
+    # How many of the 256 object directories prune() looks at each time
+    prune_shards = 16
+
+    def __init__(self, path):
+        self.path = path
+        self.objects_dir = os.path.join(path, 'objects')
+        if not os.path.exists(self.objects_dir):
+            os.makedirs(self.objects_dir)
+        # Digests of source files, keyed by path, so that unchanged files
+        # aren't hashed again
+        self.index_path = os.path.join(path, 'index.json')
+        try:
+            with open(self.index_path) as f:
+                self._index = json.load(f)
+        except (IOError, ValueError):
+            self._index = {}
+        self._index_dirty = False
+
+    def object_path(self, digest, mode):
+        name = '%s.%o' % (digest, stat.S_IMODE(mode))
+        return os.path.join(self.objects_dir, digest[:2], name)
+
+    def digest(self, path, st=None, use_index=False):
+        """Returns the sha1 of path's contents"""
+        if st is None:
+            st = os.stat(path)
+        key = [st.st_size, st.st_mtime, st.st_ino]
+        if use_index:
+            entry = self._index.get(path)
+            if entry and entry[0] == key:
+                return entry[1]
+
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(1024 * 1024)
+                if not block:
+                    break
+                h.update(block)
+        digest = h.hexdigest()
+
+        if use_index:
+            self._index[path] = [key, digest]
+            self._index_dirty = True
+        return digest
+
+    def add(self, path, link=False, use_index=False):
+        """Adds path to the store, returning the object's path.
+
+        If link is True, path itself becomes the object (when they're on the
+        same filesystem); otherwise its contents are copied.
+        """
+        st = os.stat(path)
+        obj = self.object_path(self.digest(path, st, use_index), st.st_mode)
+        if os.path.exists(obj):
+            return obj
+
+        obj_dir = os.path.dirname(obj)
+        if not os.path.exists(obj_dir):
+            os.makedirs(obj_dir)
+        if link:
+            try:
+                os.link(path, obj)
+                _make_readonly(obj, st)
+                return obj
+            except OSError, e:
+                if e.errno == errno.EEXIST:
+                    return obj
+                log.debug("couldn't link %s into the store; copying it", path, exc_info=True)
+        fd, tmp = tempfile.mkstemp(dir=obj_dir)
+        os.close(fd)
+        try:
+            copy_contents(path, tmp)
+            shutil.copystat(path, tmp)
+            _make_readonly(tmp, st)
+            os.rename(tmp, obj)
+        except:
+            _unlink(tmp)
+            raise
+        return obj
+
+    def link(self, obj, dst):
+        """Makes dst a hardlink to obj, unless it already is one. Returns
+        True if dst was changed."""
+        try:
+            if os.path.samefile(obj, dst):
+                return False
+        except OSError:
+            pass
+
+        dst_dir = os.path.dirname(dst)
+        if not os.path.exists(dst_dir):
+            os.makedirs(dst_dir)
+        # Link to a temporary name, and rename it over dst, so dst is never
+        # missing or partially written
+        tmp = os.path.join(dst_dir, '.%s.tmp' % os.path.basename(dst))
+        _unlink(tmp)
+        try:
+            os.link(obj, tmp)
+        except OSError:
+            log.debug("couldn't link %s to %s; copying it", obj, dst, exc_info=True)
+            copy_contents(obj, tmp)
+            shutil.copystat(obj, tmp)
+        os.rename(tmp, dst)
+        return True
+
+    def install(self, src, dst):
+        """Puts a copy of the file src at dst, via the store. Returns True if
+        dst was changed."""
+        obj = self.add(src, use_index=True)
+        if self.link(obj, dst):
+            log.info("Linked %s to %s", src, dst)
+            return True
+        return False
+
+    def dedupe(self, path):
+        """Replaces every file under path with a link into the store.
+
+        Returns how many bytes were saved by sharing them with files that
+        were already in the store.
+        """
+        saved = 0
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                filename = os.path.join(root, f)
+                st = os.lstat(filename)
+                if not stat.S_ISREG(st.st_mode) or st.st_nlink > 1:
+                    # Symlinks and such are left alone, and files with
+                    # other links are already in the store
+                    continue
+                obj = self.add(filename, link=True)
+                if self.link(obj, filename):
+                    saved += st.st_size
+        log.debug("%s: saved %i bytes", path, saved)
+        return saved
+
+    def prune(self, shards=None):
+        """Removes objects that no output directory links to any more.
+
+        Only `shards` (default prune_shards) of the 256 object directories
+        are looked at each time, carrying on from where the last call left
+        off, so each call is cheap and every object gets looked at once
+        every 256 / shards calls."""
+        if shards is None:
+            shards = self.prune_shards
+        position_path = os.path.join(self.path, 'prune_position')
+        try:
+            with open(position_path) as f:
+                position = int(f.read().strip() or 0)
+        except (IOError, ValueError):
+            position = 0
+
+        removed = 0
+        for i in range(position, position + shards):
+            shard_dir = os.path.join(self.objects_dir, '%02x' % (i % 256))
+            try:
+                names = os.listdir(shard_dir)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            for f in names:
+                obj = os.path.join(shard_dir, f)
+                try:
+                    if os.lstat(obj).st_nlink == 1:
+                        _unlink(obj)
+                        removed += 1
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+        atomic_write(position_path, "%i\n" % ((position + shards) % 256))
+        log.debug("pruned %i objects", removed)
+        return removed
+
+    def save(self):
+        if not self._index_dirty:
+            return
+        atomic_write_json(self.index_path, self._index)
+        self._index_dirty = False
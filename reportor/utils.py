@@ -1,5 +1,10 @@
 "Common helper functions"
+import os
+import json
+import errno
+import ctypes
 import calendar
+import tempfile
 
 
 def td2s(td):
@@ -20,3 +25,81 @@ def date2ts(d):
 def avg(l):
     """Returns the average value of list l"""
     return sum(l) / float(len(l))
+
+
+def median(l):
+    """Returns the median value of list l"""
+    l = sorted(l)
+    mid = len(l) // 2
+    if len(l) % 2:
+        return l[mid]
+    return (l[mid - 1] + l[mid]) / 2.0
+
+
+def percentile(l, p):
+    """Returns the p-th percentile of list l, interpolating between the
+    closest values"""
+    l = sorted(l)
+    k = (len(l) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(l) - 1)
+    return l[lo] + (l[hi] - l[lo]) * (k - lo)
+
+
+def report_state_dir():
+    """Returns a directory where the running report can keep state between
+    runs, creating it if needed"""
+    name = os.environ.get('REPORTOR_NAME') or os.path.basename(os.getcwd())
+    if 'REPORTOR_STATE_DIR' in os.environ:
+        path = os.path.join(os.environ['REPORTOR_STATE_DIR'], 'reports', name)
+    else:
+        path = os.path.join(os.path.expanduser('~/.reportor/reports'), name)
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    return path
+
+
+def atomic_write(path, data, mode=0o644):
+    """Writes data to path through a temporary file that's renamed over it,
+    so readers never see it partially written"""
+    dirname, basename = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(dir=dirname or os.curdir, prefix='.%s.' % basename, suffix='.tmp')
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def atomic_write_json(path, obj):
+    """Writes obj to path as JSON, with atomic_write"""
+    atomic_write(path, json.dumps(obj))
+
+
+_AT_FDCWD = -100
+_RENAME_EXCHANGE = 2
+try:
+    _renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+except (OSError, AttributeError):
+    _renameat2 = None
+
+
+def exchange(a, b):
+    """Atomically swaps paths a and b, which must both exist. Returns False
+    if the system or filesystem can't do that."""
+    if _renameat2 is None:
+        return False
+    if _renameat2(_AT_FDCWD, a, _AT_FDCWD, b, _RENAME_EXCHANGE) == 0:
+        return True
+    e = ctypes.get_errno()
+    if e in (errno.ENOSYS, errno.EINVAL, errno.ENOTSUP):
+        return False
+    raise OSError(e, os.strerror(e), b)
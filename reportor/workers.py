@@ -0,0 +1,284 @@
+"""
+A pool of pre-forked Python workers for running reports in-process
+
+Most reports are short Python scripts that spend much of their time starting
+up: a shell, a new interpreter, and importing requests, sqlalchemy, yaml and
+friends. Reports with `runner: python` are instead run by a worker forked
+from reportor after those modules have already been imported.
+
+Each worker runs a single report and then exits, so reports can't affect
+each other. Workers are our direct children, so they're reaped, timed and
+killed like any other report.
+"""
+import os
+import sys
+import imp
+import runpy
+import fcntl
+import errno
+import atexit
+import shlex
+import signal
+import logging
+import cPickle as pickle
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PRELOAD = ['json', 'yaml', 'requests', 'sqlalchemy', 'furl',
+                   'reportor.config', 'reportor.graphite', 'reportor.utils']
+
+
+def parse_command(command):
+    """Returns the argv of the Python script that `command` runs, without
+    the interpreter"""
+    if isinstance(command, basestring):
+        argv = shlex.split(command)
+    else:
+        argv = list(command)
+    if argv and os.path.basename(argv[0]).startswith('python'):
+        argv = argv[1:]
+    if not argv:
+        raise ValueError("no script in %r" % command)
+    return argv
+
+
+class WorkerProcess(object):
+    """Enough of the Popen interface for ReportRun"""
+    returncode = None
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self._set_status(status)
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            _, status = os.waitpid(self.pid, 0)
+            self._set_status(status)
+        return self.returncode
+
+    def _set_status(self, status):
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+
+
+class WorkerPool(object):
+    """
+    Keeps `size` idle workers around, with the modules in `preload`
+    imported.
+    """
+    def __init__(self, size=2, preload=DEFAULT_PRELOAD):
+        self.size = size
+        self.preload = preload
+        for module in preload:
+            try:
+                __import__(module)
+            except ImportError:
+                log.debug("couldn't preload %s", module, exc_info=True)
+        # pid -> write end of the worker's job pipe
+        self._idle = {}
+        self._fill()
+
+    def recycle(self):
+        """Replaces the idle workers with new ones, with our own preloaded
+        modules reloaded, so that reports see changes to them"""
+        self.close()
+        for module in self.preload:
+            # Reloading third party packages in place isn't safe
+            if module.startswith('reportor.') and module in sys.modules:
+                try:
+                    reload(sys.modules[module])
+                except Exception:
+                    log.warn("couldn't reload %s", module, exc_info=True)
+        self._fill()
+
+    def _fill(self):
+        while len(self._idle) < self.size:
+            self._fork()
+
+    def _fork(self):
+        r, w = os.pipe()
+        fcntl.fcntl(w, fcntl.F_SETFD, fcntl.fcntl(w, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        pid = os.fork()
+        if pid == 0:
+            os.close(w)
+            for fd in self._idle.values():
+                os.close(fd)
+            # reportor's exit handlers aren't ours to run
+            if hasattr(atexit, '_clear'):
+                atexit._clear()
+            else:
+                del atexit._exithandlers[:]
+            _worker_main(r)
+            # Not reached
+        os.close(r)
+        # The worker does this too, but we might signal it before it's had
+        # a chance to
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        self._idle[pid] = w
+        log.debug("forked worker %i", pid)
+
+    def spawn(self, argv, cwd, env, stdout_path, stderr_path):
+        """Runs argv (a Python script and its arguments) in an idle worker,
+        and returns a WorkerProcess for it"""
+        job = pickle.dumps({
+            'argv': argv,
+            'cwd': cwd,
+            'env': env,
+            'stdout': stdout_path,
+            'stderr': stderr_path,
+        }, 2)
+        while True:
+            if not self._idle:
+                self._fork()
+            pid, w = self._idle.popitem()
+            try:
+                _write_all(w, job)
+            except OSError, e:
+                if e.errno != errno.EPIPE:
+                    raise
+                log.debug("worker %i has gone away", pid)
+                continue
+            finally:
+                os.close(w)
+            self._fill()
+            return WorkerProcess(pid)
+
+    def close(self):
+        """Shuts down the idle workers"""
+        for pid, w in self._idle.items():
+            os.close(w)
+            try:
+                os.waitpid(pid, 0)
+            except OSError, e:
+                if e.errno != errno.ECHILD:
+                    raise
+        self._idle = {}
+
+
+def _write_all(fd, data):
+    while data:
+        n = os.write(fd, data)
+        data = data[n:]
+
+
+def _read_all(fd):
+    chunks = []
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            return ''.join(chunks)
+        chunks.append(chunk)
+
+
+def _close_fds(keep):
+    """Closes all our file descriptors except stdio and keep"""
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = range(3, min(os.sysconf('SC_OPEN_MAX'), 65536))
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def _worker_main(job_fd):
+    """Waits for a job, runs it, and exits"""
+    code = 1
+    try:
+        # Undo anything reportor has set up for itself
+        signal.set_wakeup_fd(-1)
+        for signum in (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+        # Put ourselves in our own process group, so we can be killed along
+        # with our children
+        os.setpgrp()
+        # Don't hold on to reportor's files, pipes and sockets
+        _close_fds(keep=[job_fd])
+
+        data = _read_all(job_fd)
+        os.close(job_fd)
+        if not data:
+            # The pool is shutting down
+            os._exit(0)
+        job = pickle.loads(data)
+        code = _run_job(job)
+    except SystemExit, e:
+        code = e.code
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        try:
+            try:
+                atexit._run_exitfuncs()
+            except BaseException:
+                # They've already been printed
+                pass
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            if code is None:
+                code = 0
+            elif not isinstance(code, int):
+                sys.stderr.write("%s\n" % code)
+                code = 1
+            os._exit(code)
+
+
+def _run_job(job):
+    os.chdir(job['cwd'])
+    os.environ.clear()
+    os.environ.update(job['env'])
+
+    stdin = os.open(os.devnull, os.O_RDONLY)
+    stdout = os.open(job['stdout'], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    stderr = os.open(job['stderr'], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    for fd, target in ((stdin, 0), (stdout, 1), (stderr, 2)):
+        os.dup2(fd, target)
+        os.close(fd)
+    sys.stdout = os.fdopen(1, 'w')
+    sys.stderr = os.fdopen(2, 'w', 0)
+
+    # Reports configure logging themselves
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.setLevel(logging.WARNING)
+
+    argv = job['argv']
+    if argv[0] == '-m':
+        sys.argv = argv[1:]
+        sys.path.insert(0, '')
+        runpy._run_module_as_main(argv[1], alter_argv=False)
+    else:
+        sys.argv = argv
+        sys.path.insert(0, os.path.dirname(os.path.abspath(argv[0])))
+        _run_script(argv[0])
+    return 0
+
+
+def _run_script(path):
+    """Runs path as __main__, the way the interpreter would"""
+    # Unlike runpy.run_path, this leaves the module alive afterwards, so
+    # that exit handlers can still use its globals
+    main = imp.new_module('__main__')
+    main.__file__ = path
+    main.__builtins__ = __builtins__
+    sys.modules['__main__'] = main
+    with open(path, 'rU') as f:
+        code = compile(f.read() + '\n', path, 'exec')
+    exec code in main.__dict__
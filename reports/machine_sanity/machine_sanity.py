@@ -4,14 +4,18 @@
 from collections import defaultdict
 import json
 import logging
+import re
 from os import devnull, path
 import shutil
-from subprocess import check_call
+from subprocess import check_call, check_output
 import sys
-from tempfile import mkdtemp
 
 from furl import furl
-import requests
+
+import reportor.cache
+import reportor.http
+import reportor.series
+from reportor.utils import atomic_write_json, report_state_dir
 
 # These are imports from https://hg.mozilla.org/build/cloud-tools.
 # If the full couldtools library didn't depend on so many things we don't need
@@ -66,16 +70,31 @@ REQUIRED_DNS_RECORDS = ["A", "PTR", "CNAME"]
 DECOMM_STATUS = 6
 
 
+# All of SKIP_PATTERNS in one go
+SKIP_RE = re.compile("|".join(re.escape(pat) for pat in SKIP_PATTERNS))
+
+# name -> the skip pattern it matches, or None. The same names are checked
+# over and over.
+_skip_patterns = {}
+
+
+def skip_pattern(name):
+    """Returns the skip pattern that name matches, or None"""
+    try:
+        return _skip_patterns[name]
+    except KeyError:
+        m = SKIP_RE.search(name)
+        pat = _skip_patterns[name] = m.group(0) if m else None
+        return pat
+
+
 def matches_skip_pattern(name):
-    for pat in SKIP_PATTERNS:
-        if pat in name:
-            return True
-    return False
+    return skip_pattern(name) is not None
 
 
 def should_skip(name, i):
     if matches_skip_pattern(name):
-        log.info("Skipping %s because it matches a skip pattern", name)
+        log.info("Skipping %s because it matches the skip pattern %r", name, skip_pattern(name))
         return True
     if "FQDN" not in i.tags:
         log.info("Skipping %s because it has no FQDN", name)
@@ -102,18 +121,27 @@ def ptr2ip(ptr):
     return ".".join(ip)
 
 
+def get_shared_json(url):
+    """Fetches url, sharing it with the other reports in this run"""
+    def fetch():
+        resp = reportor.http.get(url)
+        resp.raise_for_status()
+        return resp.content
+    return json.loads(reportor.cache.shared().get_or_fetch(url, fetch))
+
+
 def get_slavealloc_machines(slavealloc):
     log.info("Getting slavealloc machines")
     machines = {}
     url = furl(slavealloc)
     url.path.add("slaves")
-    for slave in requests.get(str(url)).json():
+    for slave in get_shared_json(str(url)):
         if not matches_skip_pattern(slave["name"]):
             machines[slave["name"]] = slave
 
     url = furl(slavealloc)
     url.path.add("masters")
-    for master in requests.get(str(url)).json():
+    for master in get_shared_json(str(url)):
         if not matches_skip_pattern(master["fqdn"]):
             machines[master["fqdn"].split(".")[0]] = master
 
@@ -121,48 +149,86 @@ def get_slavealloc_machines(slavealloc):
     return machines
 
 
+def hg_output(args):
+    with open(devnull, 'w') as null:
+        return check_output(["hg"] + args, stderr=null).strip()
+
+
+def update_mirror(repo, mirror):
+    """Brings our mirror of repo up to date, cloning it if needed. Returns
+    the revision of its default branch."""
+    if not path.exists(path.join(mirror, ".hg")):
+        if path.exists(mirror):
+            shutil.rmtree(mirror)
+        with open(devnull, 'w') as null:
+            check_call(["hg", "clone", "--noupdate", repo, mirror], stdout=null)
+    else:
+        with open(devnull, 'w') as null:
+            check_call(["hg", "pull", "-R", mirror, repo], stdout=null)
+    return hg_output(["identify", "--id", "-R", mirror, "-r", "default"])
+
+
+def load_slaves(bbdir):
+    """Returns the names of all the slaves in the buildbot-configs checkout
+    in bbdir"""
+    machines = set()
+    for dir_ in ("mozilla", "mozilla-tests"):
+        # We're looking for all slaves, and staging configs have both
+        # the production and staging slaves defined, so sourcing from
+        # those is best.
+        workdir = path.join(bbdir, dir_)
+        shutil.copyfile(path.join(workdir, "staging_config.py"), path.join(workdir, "localconfig.py"))
+        sys.path.append(workdir)
+        # Because we're re-using the same namespace each time through this
+        # loop, we need to reload some modules. Even though we're only
+        # directly accessing "config", it depends on localconfig (which is staging_config),
+        # which depends on production_config. If we don't reload each of
+        # these, they'll end up being the same as the previous iteration
+        # of the loop.
+        import production_config
+        reload(production_config)
+        import localconfig
+        reload(localconfig)
+        import config
+        reload(config)
+        for _, slaves in config.SLAVES.iteritems():
+            # Slave lists can be lists, or dicts. We need to handle both.
+            if hasattr(slaves, "keys"):
+                machines.update(slaves.keys())
+            else:
+                machines.update(slaves)
+        sys.path.remove(workdir)
+    return machines
+
+
 def get_buildbot_machines(buildbot_configs):
+    """Returns the slaves in buildbot_configs.
+
+    buildbot-configs is mirrored in our state directory between runs, and
+    only re-read when its default branch has changed.
+    """
     log.info("Getting buildbot machines")
-    machines = set()
-    workdir = mkdtemp()
-    bbdir = path.join(workdir, "buildbot-configs")
+    state_dir = report_state_dir()
+    bbdir = path.join(state_dir, "buildbot-configs")
+    cache_file = path.join(state_dir, "buildbot-slaves.json")
     try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+
+    revision = update_mirror(buildbot_configs, bbdir)
+    if cache.get("revision") == revision:
+        log.info("buildbot-configs is unchanged at %s", revision)
+        slaves = cache["slaves"]
+    else:
+        log.info("Reading slaves from buildbot-configs %s", revision)
         with open(devnull, 'w') as null:
-            check_call(["hg", "clone", buildbot_configs, bbdir], stdout=null)
-
-        for dir_ in ("mozilla", "mozilla-tests"):
-            # We're looking for all slaves, and staging configs have both
-            # the production and staging slaves defined, so sourcing from
-            # those is best.
-            workdir = path.join(bbdir, dir_)
-            shutil.copyfile(path.join(workdir, "staging_config.py"), path.join(workdir, "localconfig.py"))
-            sys.path.append(workdir)
-            # Because we're re-using the same namespace each time through this
-            # loop, we need to reload some modules. Even though we're only
-            # directly accessing "config", it depends on localconfig (which is staging_config),
-            # which depends on production_config. If we don't reload each of
-            # these, they'll end up being the same as the previous iteration
-            # of the loop.
-            import production_config
-            reload(production_config)
-            import localconfig
-            reload(localconfig)
-            import config
-            reload(config)
-            for _, slaves in config.SLAVES.iteritems():
-                # Slave lists can be lists, or dicts. We need to handle both.
-                if hasattr(slaves, "keys"):
-                    for s in slaves.keys():
-                        if not matches_skip_pattern(s):
-                            machines.add(s)
-                else:
-                    for s in slaves:
-                        if not matches_skip_pattern(s):
-                            machines.add(s)
-            sys.path.remove(workdir)
-        return machines
-    finally:
-        shutil.rmtree(workdir)
+            check_call(["hg", "update", "-R", bbdir, "--clean", "-r", revision], stdout=null)
+        slaves = sorted(load_slaves(bbdir))
+        atomic_write_json(cache_file, {"revision": revision, "slaves": slaves})
+
+    return set(s for s in slaves if not matches_skip_pattern(s))
 
 
 def filter_aws_slaves(slavealloc_machines, regions=DEFAULT_REGIONS):
@@ -175,18 +241,21 @@ def filter_aws_slaves(slavealloc_machines, regions=DEFAULT_REGIONS):
 
 def get_all_inhouse_machines(inventory):
     log.info("Getting inhouse machines")
-    url = furl(inventory)
-    url.path.add("bulk_action/export")
+    urls = []
     for n in INHOUSE_NETWORKS:
+        url = furl(inventory)
+        url.path.add("bulk_action/export")
         url.args["q"] = "/\\.%s" % n
-        resp = requests.get(str(url))
+        urls.append(str(url))
+    # Fetch them all at once, but go through them in order
+    for resp in reportor.http.fetch_many(urls):
         for name, info in resp.json()["systems"].iteritems():
             name = name.split(".")[0]
             if info["system_status"] == DECOMM_STATUS:
                 log.info("Skipping %s because it has been decommissioned", name)
                 continue
             if matches_skip_pattern(name):
-                log.info("Skipping %s because it matches a skip pattern", name)
+                log.info("Skipping %s because it matches the skip pattern %r", name, skip_pattern(name))
                 continue
             yield name, info
     log.info("Done getting inhouse machines")
@@ -196,7 +265,7 @@ def get_inventory_dns(machine, inventory):
     url = furl(inventory)
     url.path.add("core/search/search_dns_text")
     url.args.add("search", "/^%s\\." % machine)
-    resp = requests.get(str(url))
+    resp = reportor.http.get(str(url))
     results = defaultdict(list)
     for line in resp.json()["text_response"].splitlines():
         if "SREG" in line:
@@ -216,7 +285,21 @@ def get_inventory_dns(machine, inventory):
     return results
 
 
-def verify_machine(name, machine_fqdn, machine_ip, inventory):
+def get_all_inventory_dns(machines, inventory, threads=16):
+    """Looks up the DNS records of all of machines at once. Returns a dict of
+    machine to its records, or to the exc_info of the error looking them
+    up."""
+    def lookup(machine):
+        try:
+            return get_inventory_dns(machine, inventory)
+        except Exception:
+            return sys.exc_info()
+    machines = sorted(set(machines))
+    log.info("Getting DNS records for %i machines", len(machines))
+    return dict(zip(machines, reportor.http.pmap(lookup, machines, threads)))
+
+
+def verify_machine(name, machine_fqdn, machine_ip, records):
     log.info("Verifying %s", name)
     # * look in slavealloc
     # ** should we check for enabled vs. disabled?
@@ -238,7 +321,9 @@ def verify_machine(name, machine_fqdn, machine_ip, inventory):
         log.debug("%s: missing from buildbot", name)
         missing_from_buildbot.add(name)
 
-    records = get_inventory_dns(name, inventory)
+    if isinstance(records, tuple):
+        # Looking them up failed
+        raise records[0], records[1], records[2]
     for type_ in REQUIRED_DNS_RECORDS:
         if len(records[type_]) != 1:
             msg = "%s: wrong number of %s records (found %d, expected 1)" % (name, type_, len(records[type_]))
@@ -308,12 +393,17 @@ if __name__ == "__main__":
         # Do not verify AWS slaves since they don't use DNS anymore
         existent_machines.add(name)
 
-    for name, details in get_all_inhouse_machines(inventory):
+    inhouse_machines = list(get_all_inhouse_machines(inventory))
+    dns = get_all_inventory_dns([name for name, details in inhouse_machines
+                                 if details.get("staticreg_set", {}).get("nic0", {}).get("ip_str")],
+                                inventory)
+
+    for name, details in inhouse_machines:
         try:
             if not details.get("staticreg_set", {}).get("nic0", {}).get("ip_str"):
                 cant_verify.append("%s is missing IP information" % name)
                 continue
-            verify_machine(name, details["hostname"], details["staticreg_set"]["nic0"]["ip_str"], inventory)
+            verify_machine(name, details["hostname"], details["staticreg_set"]["nic0"]["ip_str"], dns[name])
         except:
             log.error("Error verifying %s", name, exc_info=True)
 
@@ -363,3 +453,4 @@ if __name__ == "__main__":
 
     with open("usable_slaves.json", "w") as f:
         json.dump(sorted(usable_slaves), f)
+    reportor.series.record('machine_sanity.usable_slaves', len(usable_slaves))
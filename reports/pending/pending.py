@@ -1,59 +1,121 @@
 #!/usr/bin/env python
-import requests
+import json
 from collections import Counter
 import logging
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+import reportor.cache
+import reportor.graphite
+import reportor.http
+import reportor.series
+
 PENDING_URL = "http://buildapi.pvt.build.mozilla.org/buildapi/pending?format=json"
 RUNNING_URL = "http://buildapi.pvt.build.mozilla.org/buildapi/running?format=json"
 ALLTHETHINGS_URL = "https://secure.pub.build.mozilla.org/builddata/reports/allthethings.json"
 
+# Whether we've said that we can't stream documents
+_warned_no_ijson = False
+
+
+def pool_name(pool):
+    """Returns the name of a slave pool, from its first slave's name"""
+    # Strip off final -XXX
+    return pool[0].rsplit("-", 1)[0]
+
+
+def pool_index(allthethings):
+    """Returns a dict of buildername to pool name"""
+    slavepools = allthethings['slavepools']
+    index = {}
+    for buildername, builder in allthethings['builders'].iteritems():
+        try:
+            index[buildername] = pool_name(slavepools[builder['slavepool']])
+        except (KeyError, IndexError, TypeError):
+            logging.debug('%s: no pool', buildername, exc_info=True)
+    return index
+
+
+def iter_buildernames(fileobj, top):
+    """Yields the buildername of every build in a buildapi pending or running
+    document, which look like {top: {branch: {revision: [build, ...]}}}"""
+    global _warned_no_ijson
+    if ijson is None:
+        if not _warned_no_ijson:
+            logging.warning("ijson isn't installed; loading whole documents into memory")
+            _warned_no_ijson = True
+        doc = json.load(fileobj)
+        for revisions in doc[top].itervalues():
+            for builds in revisions.itervalues():
+                for b in builds:
+                    yield b['buildername']
+        return
+
+    # Stream it, so we never hold the whole thing in memory. Builds are the
+    # maps inside the document, top, branch, and revision list.
+    depth = 0
+    want_value = False
+    for prefix, event, value in ijson.parse(fileobj):
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+        elif event == 'map_key':
+            want_value = depth == 5 and value == 'buildername' and prefix.startswith(top + '.')
+        elif want_value:
+            yield value
+            want_value = False
+
+
+def count_builders(url, top):
+    """Returns a Counter of buildername for the builds in url"""
+    response = reportor.http.get(url, stream=True)
+    response.raise_for_status()
+    response.raw.decode_content = True
+    return Counter(iter_buildernames(response.raw, top))
+
+
+def count_by_pool(builders, index, counts):
+    """Adds the counts in builders, a Counter of buildername, to counts, a
+    Counter of pool"""
+    for buildername, n in builders.iteritems():
+        pool = index.get(buildername)
+        if pool is None:
+            logging.warning('%s: unknown pool', buildername)
+            pool = 'unknown'
+        counts[pool] += n
 
-def pool_for_builder(allthethings, buildername):
-    try:
-        pool_id = allthethings['builders'][buildername]['slavepool']
-        pool = allthethings['slavepools'][pool_id]
-        first_name = pool[0]
-        # Strip off final -XXX
-        pool = first_name.rsplit("-", 1)[0]
-        return pool
-    except:
-        logging.warning('%s: unknown pool', buildername)
-        logging.debug('%s: unknown pool', buildername, exc_info=True)
-        return 'unknown'
 
 if __name__ == '__main__':
-    import reportor.graphite
-    import json
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
-    logging.info('Fetching pending info from %s', PENDING_URL)
-    pending = requests.get(PENDING_URL).json()
-    logging.info('Fetching running info from %s', RUNNING_URL)
-    running = requests.get(RUNNING_URL).json()
-    logging.info('Fetching allthethings from %s', ALLTHETHINGS_URL)
-    allthethings = requests.get(ALLTHETHINGS_URL).json()
+    # allthethings is big and rarely changes, so it's only checked for
+    # changes hourly, and shared with other reports in this run. pending and
+    # running are counted by buildername as they're downloaded.
+    cache = reportor.http.HTTPCache()
+    logging.info('Fetching %s, %s and %s', PENDING_URL, RUNNING_URL, ALLTHETHINGS_URL)
+    pending, running, allthethings = reportor.http.pmap(lambda f: f(), [
+        lambda: count_builders(PENDING_URL, 'pending'),
+        lambda: count_builders(RUNNING_URL, 'running'),
+        lambda: json.loads(reportor.cache.shared().get_or_fetch(
+            ALLTHETHINGS_URL, lambda: cache.get(ALLTHETHINGS_URL, 3600).content)),
+    ])
+    index = pool_index(allthethings)
 
     pending_by_pool = Counter()
     running_by_pool = Counter()
 
     for pool in allthethings['slavepools'].values():
-        pending_by_pool[pool[0].rsplit('-', 1)[0]] = 0
-        running_by_pool[pool[0].rsplit('-', 1)[0]] = 0
-
-    for branch, revisions in pending['pending'].items():
-        for rev, builds in revisions.items():
-            for b in builds:
-                buildername = b['buildername']
-                pool = pool_for_builder(allthethings, buildername)
-                pending_by_pool[pool] += 1
+        pending_by_pool[pool_name(pool)] = 0
+        running_by_pool[pool_name(pool)] = 0
+
+    count_by_pool(pending, index, pending_by_pool)
     print json.dumps(pending_by_pool)
 
-    for branch, revisions in running['running'].items():
-        for rev, builds in revisions.items():
-            for b in builds:
-                buildername = b['buildername']
-                pool = pool_for_builder(allthethings, buildername)
-                running_by_pool[pool] += 1
+    count_by_pool(running, index, running_by_pool)
     print json.dumps(running_by_pool)
 
     logging.info('Submitting to graphite')
@@ -62,3 +124,8 @@ if __name__ == '__main__':
         g.submit('releng.pending.{}'.format(pool), count)
     for pool, count in running_by_pool.items():
         g.submit('releng.running.{}'.format(pool), count)
+
+    for pool, count in pending_by_pool.items():
+        reportor.series.record('pending.{}'.format(pool), count)
+    for pool, count in running_by_pool.items():
+        reportor.series.record('running.{}'.format(pool), count)
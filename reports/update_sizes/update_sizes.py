@@ -3,23 +3,95 @@
 Fetch and report sizes for complete and partial updates, and full installers
 For different branches and platforms
 """
-import requests
+import os
+import sys
+import json
+import logging
 from datetime import datetime, date, timedelta
 
-from reportor.utils import date2ts
+import requests
+
+import reportor.http
+from reportor.utils import atomic_write_json, date2ts, report_state_dir
+
+log = logging.getLogger(__name__)
 
 AUS_API_ROOT = 'https://aus-api.mozilla.org/api/v1'
 
+# Our platform names, and AUS's
+NIGHTLY_PLATFORMS = {
+    'macosx64': 'Darwin_x86_64-gcc3-u-i386-x86_64',
+    'linux64': 'Linux_x86_64-gcc3',
+    'win32': 'WINNT_x86-msvc',
+    'win64': 'WINNT_x86_64-msvc',
+}
+
+
+class SizeCache(object):
+    """
+    Sizes of artifacts that never change, kept between runs. Only the URLs
+    used by the last run are kept.
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.sizes = json.load(f)
+        except (IOError, ValueError):
+            self.sizes = {}
+        self.used = {}
+
+    def get(self, url):
+        size = self.sizes.get(url)
+        if size is not None:
+            self.used[url] = size
+        return size
+
+    def put(self, url, size):
+        self.used[url] = size
+
+    def save(self):
+        atomic_write_json(self.path, self.used)
+
 
 def get_size(url):
-    response = requests.head(url, allow_redirects=True)
-    response.raise_for_status()
+    """Returns the size of url, or None if it doesn't exist or can't be
+    fetched. Missing completes are caught by sizes_from_urls."""
+    try:
+        response = reportor.http.head(url)
+    except requests.RequestException:
+        log.warn("%s: couldn't fetch", url, exc_info=True)
+        return None
+    if response.status_code != 200:
+        if response.status_code != 404:
+            log.warn("%s: got %s", url, response.status_code)
+        return None
     return int(response.headers['content-length'])
 
 
-def url_exists(url):
-    response = requests.head(url, allow_redirects=True)
-    return response.status_code == 200
+def probe_sizes(urls, cache=None, mutable=(), threads=8):
+    """Returns a dict of url to size (or None if missing) for all of urls
+    and mutable.
+
+    Each distinct URL is only probed once, all at the same time. If cache is
+    given, sizes of urls are looked up in and added to it; mutable is for
+    URLs whose contents can change, which are always probed.
+    """
+    urls = set(urls)
+    mutable = set(mutable)
+    sizes = {}
+    if cache:
+        for url in urls - mutable:
+            size = cache.get(url)
+            if size is not None:
+                sizes[url] = size
+    todo = sorted((urls | mutable) - set(sizes))
+    log.info("probing %i urls (%i cached)", len(todo), len(sizes))
+    for url, size in zip(todo, reportor.http.pmap(get_size, todo, threads)):
+        sizes[url] = size
+        if cache and size is not None and url not in mutable:
+            cache.put(url, size)
+    return sizes
 
 
 def get_taskId(branch, platform, d):
@@ -32,18 +104,22 @@ def get_taskId(branch, platform, d):
 
 
 def get_rule_mapping(rule_id):
-    rule = requests.get('{}/rules/{}'.format(AUS_API_ROOT, rule_id)).json()
+    rule = reportor.http.get('{}/rules/{}'.format(AUS_API_ROOT, rule_id)).json()
     return rule['mapping']
 
 
 def get_release_blob(blob_name):
-    blob = requests.get('{}/releases/{}'.format(AUS_API_ROOT, blob_name)).json()
+    blob = reportor.http.get('{}/releases/{}'.format(AUS_API_ROOT, blob_name)).json()
     return blob
 
 
-def get_blobs_by_prefix(blob_prefix):
-    blobs = requests.get('{}/releases'.format(AUS_API_ROOT)).json()
-    return [r['name'] for r in blobs['releases'] if r['name'].startswith(blob_prefix)]
+def get_release_names():
+    blobs = reportor.http.get('{}/releases'.format(AUS_API_ROOT)).json()
+    return [r['name'] for r in blobs['releases']]
+
+
+def get_blobs_by_prefix(names, blob_prefix):
+    return [name for name in names if name.startswith(blob_prefix)]
 
 
 def format_bouncer_url(url, platform, locale):
@@ -56,7 +132,9 @@ def format_bouncer_url(url, platform, locale):
     return url
 
 
-def get_sizes_from_blob(blob, channel):
+def get_urls_from_blob(blob, channel):
+    """Returns {platform: {complete, installer, partials}} with the URLs of
+    each artifact in a release blob"""
     fileUrls = blob['fileUrls'].get(channel, blob['fileUrls']['*'])
     complete_url_b = fileUrls['completes']['*']
     partial_urls_b = []
@@ -68,99 +146,122 @@ def get_sizes_from_blob(blob, channel):
     retval = {}
     for platform in ('linux64', 'win64', 'win32', 'macosx64'):
         url = format_bouncer_url(complete_url_b, platform, 'en-US')
-        size = get_size(url)
-
         retval[platform] = dict(
-            complete_size=size,
-            installer_size=None,
-            partial_size=None,
+            complete=url,
+            installer=url.replace('-complete', '-SSL'),
+            partials=[format_bouncer_url(u, platform, 'en-US') for u in partial_urls_b],
         )
+    return retval
 
-        installer_url = url.replace('-complete', '-SSL')
-        if url_exists(installer_url):
-            retval[platform]['installer_size'] = get_size(installer_url)
 
-        partial_sizes = []
-        for url in partial_urls_b:
-            url = format_bouncer_url(url, platform, 'en-US')
-            size = get_size(url)
-            partial_sizes.append(size)
-        if partial_sizes:
-            retval[platform]['partial_size'] = min(partial_sizes)
+def get_urls_from_nightly_blob(blob, channel):
+    """Returns {platform: {complete, installer, partials}} with the URLs of
+    each artifact in a nightly blob"""
+    retval = {}
+    for platform, aus_platform in NIGHTLY_PLATFORMS.items():
+        en_us = blob['platforms'][aus_platform]['locales']['en-US']
+        retval[platform] = dict(
+            complete=en_us['completes'][0]['fileUrl'],
+            installer=None,
+            partials=[p['fileUrl'] for p in en_us.get('partials', [])],
+        )
     return retval
 
 
-def get_sizes_from_nightly_blob(blob, channel):
-    platforms = [
-        ('macosx64', 'Darwin_x86_64-gcc3-u-i386-x86_64'),
-        ('linux64', 'Linux_x86_64-gcc3'),
-        ('win32', 'WINNT_x86-msvc'),
-        ('win64', 'WINNT_x86_64-msvc'),
-    ]
-    retval = {}
-    for platform, aus_platform in platforms:
-        complete_url = blob['platforms'][aus_platform]['locales']['en-US']['completes'][0]['fileUrl']
-        size = get_size(complete_url)
+def sizes_from_urls(urls, sizes):
+    """Turns the output of get_urls_from_blob into sizes, using sizes from
+    probe_sizes. Raises ValueError if a complete is missing; missing
+    partials are left out."""
+    def size(url):
+        if url is None:
+            return None
+        return sizes[url]
 
+    retval = {}
+    for platform, u in urls.items():
+        if u['complete'] and sizes[u['complete']] is None:
+            raise ValueError("%s is missing" % u['complete'])
+        partial_sizes = []
+        for url in u['partials']:
+            if sizes[url] is None:
+                log.warn("%s is missing", url)
+                continue
+            partial_sizes.append(sizes[url])
         retval[platform] = dict(
-            complete_size=size,
-            partial_size=None,
+            complete_size=size(u['complete']),
+            installer_size=size(u['installer']),
+            partial_size=min(partial_sizes) if partial_sizes else None,
         )
-        if 'partials' not in blob['platforms'][aus_platform]['locales']['en-US']:
-            continue
-        partial_urls = [p['fileUrl'] for p in blob['platforms'][aus_platform]['locales']['en-US']['partials']]
-        partial_sizes = []
-        for url in partial_urls:
-            size = get_size(url)
-            partial_sizes.append(size)
-        if partial_sizes:
-            retval[platform]['partial_size'] = min(partial_sizes)
     return retval
 
 
-def get_beta_update_sizes():
-    blob_name = get_rule_mapping('firefox-beta')
-    blob = get_release_blob(blob_name)
-    update_sizes = get_sizes_from_blob(blob, 'beta')
-    return update_sizes
+def all_urls(urls):
+    """Returns every URL in the output of get_urls_from_blob"""
+    for u in urls.values():
+        if u['complete']:
+            yield u['complete']
+        if u['installer']:
+            yield u['installer']
+        for url in u['partials']:
+            yield url
+
 
+RELEASE_RULES = {
+    'mozilla-beta': ('firefox-beta', 'beta'),
+    'mozilla-release': ('firefox-release', 'release'),
+}
 
-def get_release_update_sizes():
-    blob_name = get_rule_mapping('firefox-release')
+
+def get_release_urls(branch):
+    rule_id, channel = RELEASE_RULES[branch]
+    blob_name = get_rule_mapping(rule_id)
     blob = get_release_blob(blob_name)
-    update_sizes = get_sizes_from_blob(blob, 'release')
-    return update_sizes
+    return get_urls_from_blob(blob, channel)
+
+
+def nightly_blob_name(names, branch, date):
+    """Returns the name of the blob for branch's nightly on date, or None if
+    there isn't one yet"""
+    blob_prefix = 'Firefox-{branch}-nightly-{date}'.format(date=date.strftime('%Y%m%d'), branch=branch)
+    blobs = get_blobs_by_prefix(names, blob_prefix)
+    if not blobs:
+        return None
+    return blobs[0]
 
 
-def get_nightly_update_sizes(branch, date):
-    blob_prefix = 'Firefox-{branch}-nightly-{date}'.format(date=date, branch=branch)
-    blob_name = get_blobs_by_prefix(blob_prefix)[0]
+def get_nightly_urls(blob_name):
     blob = get_release_blob(blob_name)
-    update_sizes = get_sizes_from_nightly_blob(blob, 'nightly')
-    return update_sizes
-
-
-def get_release_sizes(graphite, branches):
-    for branch in branches:
-        if branch == 'mozilla-beta':
-            sizes = get_beta_update_sizes()
-        elif branch == 'mozilla-release':
-            sizes = get_release_update_sizes()
-        else:
-            print "Don't know how to handle branch", branch
-            continue
+    return get_urls_from_nightly_blob(blob, 'nightly')
+
 
-        for platform, sizes in sizes.items():
-            print platform, sizes
-            if sizes['installer_size']:
-                graphite.submit('release_sizes.{}.{}.installer'.format(branch, platform), sizes['installer_size'])
-            if sizes['complete_size']:
-                graphite.submit('release_sizes.{}.{}.complete'.format(branch, platform), sizes['complete_size'])
-            if sizes['partial_size']:
-                graphite.submit('release_sizes.{}.{}.partial'.format(branch, platform), sizes['partial_size'])
+class SubmittedNightlies(object):
+    """
+    Which (branch, date, platform) nightly sizes have been submitted
+    already, so that they aren't looked up again
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.submitted = set(tuple(k) for k in json.load(f))
+        except (IOError, ValueError):
+            self.submitted = set()
 
+    def missing(self, branch, date, platforms):
+        """Returns which of platforms haven't been submitted"""
+        d = date.strftime('%Y%m%d')
+        return [p for p in platforms if (branch, d, p) not in self.submitted]
 
-def get_nightly_installer_sizes(branch):
+    def add(self, branch, date, platform):
+        self.submitted.add((branch, date.strftime('%Y%m%d'), platform))
+
+    def save(self, oldest):
+        """Saves what's been submitted since date oldest"""
+        oldest = oldest.strftime('%Y%m%d')
+        atomic_write_json(self.path, sorted(k for k in self.submitted if k[1] >= oldest))
+
+
+def get_nightly_installer_urls():
     platforms = ['linux64', 'macosx64', 'win32', 'win64']
     retval = {}
     for p in platforms:
@@ -169,37 +270,20 @@ def get_nightly_installer_sizes(branch):
             p,
             'en-US',
         )
-        retval[p] = {'installer_size': get_size(url)}
+        retval[p] = dict(complete=None, installer=url, partials=[])
     return retval
 
 
-def get_nightly_sizes(graphite, branches):
-    oneday = timedelta(days=1)
-    today = date.today()
-
-    days = 5
-
-    for branch in branches:
-        d = today
-        sizes = get_nightly_installer_sizes(branch)
-        ts = date2ts(d)
-        for platform, sizes in sizes.items():
-            print platform, sizes
-            if sizes['installer_size']:
-                graphite.submit('release_sizes.{}.{}.installer'.format(branch, platform), sizes['installer_size'], ts)
+def submit_sizes(graphite, branch, sizes, ts=None):
+    for platform, sizes in sizes.items():
+        print platform, sizes
+        if sizes['installer_size']:
+            graphite.submit('release_sizes.{}.{}.installer'.format(branch, platform), sizes['installer_size'], ts)
+        if sizes['complete_size']:
+            graphite.submit('release_sizes.{}.{}.complete'.format(branch, platform), sizes['complete_size'], ts)
+        if sizes['partial_size']:
+            graphite.submit('release_sizes.{}.{}.partial'.format(branch, platform), sizes['partial_size'], ts)
 
-        for i in range(days):
-            d = today - i * oneday
-            ts = date2ts(d)
-            sizes = get_nightly_update_sizes(branch, d.strftime('%Y%m%d'))
-            if not sizes:
-                continue
-            for platform, sizes in sizes.items():
-                print platform, sizes
-                if sizes['complete_size']:
-                    graphite.submit('release_sizes.{}.{}.complete'.format(branch, platform), sizes['complete_size'], ts)
-                if sizes['partial_size']:
-                    graphite.submit('release_sizes.{}.{}.partial'.format(branch, platform), sizes['partial_size'], ts)
 
 def main():
     import reportor.graphite
@@ -207,9 +291,60 @@ def main():
 
     nightly_branches = ['mozilla-central']
     release_branches = ['mozilla-beta', 'mozilla-release']
+    days = 5
 
-    get_release_sizes(graphite, release_branches)
-    get_nightly_sizes(graphite, nightly_branches)
+    # Nightly sizes don't change once they're known, so only look up the
+    # ones we haven't already submitted
+    today = date.today()
+    oldest = today - (days - 1) * timedelta(days=1)
+    submitted = SubmittedNightlies(os.path.join(report_state_dir(), 'submitted.json'))
+    names = get_release_names()
+    nightlies = []
+    for branch in nightly_branches:
+        for i in range(days):
+            d = today - i * timedelta(days=1)
+            if not submitted.missing(branch, d, NIGHTLY_PLATFORMS):
+                continue
+            blob_name = nightly_blob_name(names, branch, d)
+            if blob_name is None:
+                log.info("%s: no nightly for %s yet", branch, d)
+                continue
+            nightlies.append((branch, d, blob_name))
+    log.info("looking up %i new nightlies", len(nightlies))
+
+    # Work out everything we need to know the size of first: a list of
+    # (branch, timestamp, {platform: urls}, nightly date)
+    builds = [(branch, None, urls, None) for branch, urls in
+              zip(release_branches, reportor.http.pmap(get_release_urls, release_branches))]
+    for (branch, d, _), urls in zip(nightlies, reportor.http.pmap(get_nightly_urls, [n[2] for n in nightlies])):
+        missing = submitted.missing(branch, d, urls.keys())
+        builds.append((branch, date2ts(d), dict((p, urls[p]) for p in missing), d))
+    # The latest nightly installer changes, so its size can't be cached
+    latest = [(branch, date2ts(today), get_nightly_installer_urls(), None) for branch in nightly_branches]
+
+    # Then find them all at once
+    cache = SizeCache(os.path.join(report_state_dir(), 'sizes.json'))
+    sizes = probe_sizes([url for _, _, urls, _ in builds for url in all_urls(urls)], cache,
+                        mutable=[url for _, _, urls, _ in latest for url in all_urls(urls)])
+
+    # A build with a missing complete shouldn't stop the others from being
+    # submitted
+    failed = 0
+    for branch, ts, urls, d in latest + builds:
+        try:
+            build_sizes = sizes_from_urls(urls, sizes)
+        except ValueError:
+            log.error("%s: not submitting sizes for %s", branch, d or 'the latest release', exc_info=True)
+            failed += 1
+            continue
+        submit_sizes(graphite, branch, build_sizes, ts)
+        if d is not None:
+            for platform in urls:
+                submitted.add(branch, d, platform)
+    cache.save()
+    submitted.save(oldest)
+    if failed:
+        sys.exit("couldn't work out the sizes of %i builds" % failed)
 
 if __name__ == '__main__':
     main()
@@ -11,7 +11,7 @@ setup(name='reportor',
       install_requires=[
           'pyyaml', 'argparse', 'lockfile', 'boto', 'furl', 'requests',
           'pyOpenSSL', 'ndg-httpsclient', 'pyasn1', 'beautifulsoup4',
-          'boto', 'pytz',
+          'boto', 'pytz', 'ijson',
       ],
       scripts=['scripts/reportor'],
       )
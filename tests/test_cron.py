@@ -0,0 +1,109 @@
+import unittest
+from datetime import datetime
+
+from reportor.cron import CronError, CronSchedule, IntervalSchedule, _parse_field, parse_when
+
+
+class TestParseField(unittest.TestCase):
+    def test_star(self):
+        self.assertEqual(_parse_field('*', 0, 5), set(range(6)))
+
+    def test_list_and_range(self):
+        self.assertEqual(_parse_field('1,3-5', 0, 10), set([1, 3, 4, 5]))
+
+    def test_steps(self):
+        self.assertEqual(_parse_field('*/15', 0, 59), set([0, 15, 30, 45]))
+        self.assertEqual(_parse_field('10-20/5', 0, 59), set([10, 15, 20]))
+        # A single value with a step runs to the end of the range
+        self.assertEqual(_parse_field('5/20', 0, 59), set([5, 25, 45]))
+
+    def test_names(self):
+        self.assertEqual(CronSchedule('0 0 * jan-mar *').months, set([1, 2, 3]))
+        self.assertEqual(CronSchedule('0 0 * * mon-fri').weekdays, set([1, 2, 3, 4, 5]))
+        self.assertEqual(CronSchedule('0 0 * * SUN').weekdays, set([0]))
+
+    def test_seven_is_sunday(self):
+        self.assertEqual(CronSchedule('0 0 * * 7').weekdays, set([0]))
+
+    def test_errors(self):
+        for field in ('60', '5-1', 'x', '*/0', '-1'):
+            self.assertRaises(CronError, _parse_field, field, 0, 59)
+
+    def test_field_count(self):
+        self.assertRaises(CronError, CronSchedule, '* * * *')
+        self.assertRaises(CronError, CronSchedule, '* * * * * *')
+
+
+class TestNextAfter(unittest.TestCase):
+    def next_after(self, expr, dt):
+        return parse_when(expr).next_after(dt)
+
+    def test_hourly(self):
+        self.assertEqual(self.next_after('hourly', datetime(2020, 1, 1, 10, 30)),
+                         datetime(2020, 1, 1, 11, 0))
+
+    def test_strictly_after(self):
+        self.assertEqual(self.next_after('hourly', datetime(2020, 1, 1, 10, 0)),
+                         datetime(2020, 1, 1, 11, 0))
+        self.assertEqual(self.next_after('hourly', datetime(2020, 1, 1, 10, 0, 59, 999)),
+                         datetime(2020, 1, 1, 11, 0))
+
+    def test_every_minute(self):
+        self.assertEqual(self.next_after('* * * * *', datetime(2020, 1, 1, 10, 0, 30)),
+                         datetime(2020, 1, 1, 10, 1))
+
+    def test_day_rollover(self):
+        self.assertEqual(self.next_after('30 6 * * *', datetime(2020, 1, 1, 7, 0)),
+                         datetime(2020, 1, 2, 6, 30))
+
+    def test_month_and_year_rollover(self):
+        self.assertEqual(self.next_after('monthly', datetime(2020, 1, 31, 12, 0)),
+                         datetime(2020, 2, 1, 0, 0))
+        self.assertEqual(self.next_after('0 0 1 jan *', datetime(2020, 6, 1)),
+                         datetime(2021, 1, 1, 0, 0))
+        self.assertEqual(self.next_after('0 0 * * *', datetime(2020, 12, 31, 23, 59)),
+                         datetime(2021, 1, 1, 0, 0))
+
+    def test_weekly(self):
+        # 2020-01-01 was a Wednesday
+        self.assertEqual(self.next_after('weekly', datetime(2020, 1, 1)), datetime(2020, 1, 5, 0, 0))
+        self.assertEqual(self.next_after('0 9 * * mon-fri', datetime(2020, 1, 3, 10, 0)),
+                         datetime(2020, 1, 6, 9, 0))
+
+    def test_day_fields_are_ored(self):
+        # The 15th, or any Monday
+        schedule = '0 0 15 * mon'
+        self.assertEqual(self.next_after(schedule, datetime(2020, 1, 1)), datetime(2020, 1, 6))
+        self.assertEqual(self.next_after(schedule, datetime(2020, 1, 13, 1)), datetime(2020, 1, 15))
+
+    def test_leap_day(self):
+        self.assertEqual(self.next_after('0 0 29 2 *', datetime(2021, 1, 1)), datetime(2024, 2, 29))
+
+    def test_never(self):
+        self.assertRaises(CronError, self.next_after, '0 0 31 2 *', datetime(2020, 1, 1))
+        self.assertRaises(CronError, self.next_after, '0 0 30 feb *', datetime(2020, 1, 1))
+
+
+class TestIntervals(unittest.TestCase):
+    def test_parse(self):
+        for when, seconds in (('every 10m', 600), ('every 2h', 7200), ('30s', 30), ('every 1d', 86400)):
+            schedule = parse_when(when)
+            self.assertTrue(isinstance(schedule, IntervalSchedule))
+            self.assertEqual(schedule.seconds, seconds)
+
+    def test_bad(self):
+        self.assertRaises(CronError, parse_when, 'every 0s')
+        self.assertRaises(CronError, parse_when, 'every 10 fortnights')
+
+    def test_aligned_to_epoch(self):
+        schedule = parse_when('every 15m')
+        self.assertEqual(schedule.next_after(datetime(2020, 1, 1, 10, 7, 30)), datetime(2020, 1, 1, 10, 15))
+        self.assertEqual(schedule.next_after(datetime(2020, 1, 1, 10, 15)), datetime(2020, 1, 1, 10, 30))
+
+    def test_str(self):
+        self.assertEqual(str(parse_when('every 2h')), 'every 7200s')
+        self.assertEqual(str(parse_when('daily')), '0 0 * * *')
+
+
+if __name__ == '__main__':
+    unittest.main()
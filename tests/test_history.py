@@ -0,0 +1,38 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from reportor import run_manifest
+from reportor.history import RunHistory
+
+
+class TestMaxRSS(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.history = RunHistory(os.path.join(self.tmpdir, 'history.sqlite'))
+        self.addCleanup(self.history.close)
+
+    def max_rss(self, command):
+        basedir = os.path.join(self.tmpdir, 'out')
+        os.makedirs(basedir)
+        run_manifest({'r': {'command': command, 'cwd': self.tmpdir}}, basedir, datetime(2020, 1, 1),
+                     history=self.history)
+        shutil.rmtree(basedir)
+        return self.history.db.execute("SELECT max_rss FROM runs ORDER BY id DESC LIMIT 1").fetchone()[0]
+
+    def test_small_reports(self):
+        # A report that uses less memory than reportor itself would just
+        # report reportor's peak RSS
+        self.assertEqual(self.max_rss('true'), None)
+
+    def test_big_reports(self):
+        max_rss = self.max_rss('%s -c "x = 200 * 1024 * 1024 * \'x\'"' % sys.executable)
+        self.assertTrue(max_rss > 200 * 1024 * 1024, max_rss)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from reportor import run_manifest
+from reportor.incremental import IncrementalState
+
+
+class TestBatches(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.state = IncrementalState(os.path.join(self.tmpdir, 'state'))
+        self.input = os.path.join(self.tmpdir, 'input')
+        self.b_runs = os.path.join(self.tmpdir, 'b_runs')
+        self.manifest = {
+            'a': {'command': 'cat %s' % self.input, 'cwd': self.tmpdir},
+            'b': {'command': 'echo ran >> %s; cat $OUTPUT_DIR/../a/output.txt' % self.b_runs,
+                  'requires': ['a'], 'cache': True, 'cwd': self.tmpdir},
+        }
+        self.batches = 0
+
+    def run_batch(self, a_output):
+        with open(self.input, 'w') as f:
+            f.write(a_output)
+        self.batches += 1
+        basedir = os.path.join(self.tmpdir, 'out', str(self.batches))
+        os.makedirs(basedir)
+        run_manifest(self.manifest, basedir, datetime(2020, 1, 1, 0, self.batches),
+                     incremental=self.state)
+        with open(os.path.join(basedir, 'b', 'output.txt')) as f:
+            return f.read()
+
+    def b_ran(self):
+        with open(self.b_runs) as f:
+            return len(f.readlines())
+
+    def test_unchanged_inputs_are_reused(self):
+        self.assertEqual(self.run_batch('one'), 'one')
+        self.assertEqual(self.run_batch('one'), 'one')
+        self.assertEqual(self.b_ran(), 1)
+
+    def test_changed_inputs_across_batches(self):
+        # One IncrementalState for several batches, as `reportor serve` does
+        self.assertEqual(self.run_batch('one'), 'one')
+        self.assertEqual(self.run_batch('two'), 'two')
+        self.assertEqual(self.run_batch('three'), 'three')
+        self.assertEqual(self.b_ran(), 3)
+        self.assertEqual(self.run_batch('three'), 'three')
+        self.assertEqual(self.b_ran(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
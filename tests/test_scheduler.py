@@ -0,0 +1,219 @@
+import os
+import time
+import signal
+import unittest
+import subprocess
+
+from reportor.scheduler import Scheduler, exitstatus_to_returncode
+
+
+class FakeRun(object):
+    """Enough of a ReportRun for the scheduler. Runs `sleep duration`, or
+    nothing at all if duration is None."""
+    def __init__(self, log, name, config):
+        self.log = log
+        self.name = name
+        self.duration = config.get('duration')
+        self.maxtime = config.get('maxtime', 60)
+        self.kill_grace = 1
+        self.killed = False
+        self.proc = None
+        self.start_time = self.end_time = None
+        self.returncode = None
+
+    @property
+    def pid(self):
+        return self.proc.pid if self.proc else None
+
+    def start(self):
+        self.start_time = time.time()
+        self.log.started(self.name)
+        if self.duration is None:
+            self.end_time = time.time()
+            return
+        self.proc = subprocess.Popen(['sleep', str(self.duration)])
+
+    def reaped(self, status, rusage):
+        self.end_time = time.time()
+        self.returncode = exitstatus_to_returncode(status)
+        self.proc.returncode = self.returncode
+
+    def wait(self):
+        self.log.finished(self.name)
+
+    def kill(self, signum=signal.SIGKILL):
+        self.killed = True
+        os.kill(self.proc.pid, signum)
+
+
+class RunLog(object):
+    def __init__(self):
+        self.order = []
+        self.running = set()
+        self.max_running = 0
+
+    def started(self, name):
+        self.order.append(name)
+        self.running.add(name)
+        self.max_running = max(self.max_running, len(self.running))
+
+    def finished(self, name):
+        self.running.discard(name)
+
+    def make_run(self, name, config):
+        return FakeRun(self, name, config)
+
+
+class SchedulerTest(unittest.TestCase):
+    def run_manifest(self, m, **kwargs):
+        log = RunLog()
+        done = []
+        s = Scheduler(**kwargs)
+        s.submit(m, log.make_run, on_done=lambda: done.append(True))
+        s.run()
+        self.assertEqual(done, [True])
+        return log
+
+
+class TestOrdering(SchedulerTest):
+    def test_requirements_run_first(self):
+        log = self.run_manifest({
+            'a': {'requires': ['b']},
+            'b': {'requires': ['c']},
+            'c': {},
+        })
+        self.assertEqual(log.order, ['c', 'b', 'a'])
+
+    def test_critical_path_first(self):
+        # With one slot, the start of the longest chain goes first, even
+        # though "short" takes longer on its own
+        estimates = {'short': 5, 'chain1': 2, 'chain2': 10}
+        log = self.run_manifest({
+            'short': {},
+            'chain1': {},
+            'chain2': {'requires': ['chain1']},
+        }, jobs=1, estimate=estimates.get)
+        self.assertEqual(log.order, ['chain1', 'chain2', 'short'])
+
+    def test_unknown_estimates_use_the_average(self):
+        estimates = {'a': 10, 'b': 2}
+        log = self.run_manifest({'a': {}, 'b': {}, 'c': {}}, jobs=1, estimate=estimates.get)
+        # c is assumed to take 6s
+        self.assertEqual(log.order, ['a', 'c', 'b'])
+
+    def test_missing_requirement(self):
+        log = self.run_manifest({
+            'a': {'requires': ['nope']},
+            'b': {'requires': ['a']},
+            'c': {},
+        })
+        self.assertEqual(log.order, ['c'])
+
+    def test_cycle(self):
+        log = self.run_manifest({
+            'a': {'requires': ['b']},
+            'b': {'requires': ['a']},
+            'c': {},
+        })
+        self.assertEqual(log.order, ['c'])
+
+    def test_nothing_runnable(self):
+        log = self.run_manifest({'a': {'requires': ['a']}})
+        self.assertEqual(log.order, [])
+
+    def test_make_run_errors_dont_stop_the_others(self):
+        log = RunLog()
+        done = []
+
+        def make_run(name, config):
+            if name == 'bad':
+                raise RuntimeError("oops")
+            return log.make_run(name, config)
+        s = Scheduler()
+        s.submit({'bad': {}, 'after': {'requires': ['bad']}, 'good': {}}, make_run,
+                 on_done=lambda: done.append(True))
+        s.run()
+        self.assertEqual(sorted(log.order), ['after', 'good'])
+        self.assertEqual(done, [True])
+
+
+class TestSlotsAndLocks(SchedulerTest):
+    def manifest(self, n, **config):
+        config.setdefault('duration', 0.2)
+        return dict(('r%i' % i, dict(config)) for i in range(n))
+
+    def test_unlimited(self):
+        log = self.run_manifest(self.manifest(4))
+        self.assertEqual(log.max_running, 4)
+
+    def test_jobs_limit(self):
+        log = self.run_manifest(self.manifest(4), jobs=2)
+        self.assertEqual(log.max_running, 2)
+
+    def test_slots(self):
+        m = self.manifest(3)
+        m['big'] = {'duration': 0.2, 'slots': 2}
+        log = self.run_manifest(m, jobs=2)
+        self.assertEqual(log.max_running, 2)
+        self.assertEqual(len(log.order), 4)
+
+    def test_slots_are_limited_to_jobs(self):
+        log = self.run_manifest({'huge': {'duration': None, 'slots': 10}}, jobs=2)
+        self.assertEqual(log.order, ['huge'])
+
+    def test_lock(self):
+        log = self.run_manifest(self.manifest(3, locks=['db']))
+        self.assertEqual(log.max_running, 1)
+
+    def test_lock_capacity(self):
+        log = self.run_manifest(self.manifest(4, locks=['db']), resources={'db': 2})
+        self.assertEqual(log.max_running, 2)
+
+    def test_lock_amounts(self):
+        m = self.manifest(2, locks={'db': 1})
+        m['heavy'] = {'duration': 0.2, 'locks': {'db': 3}}
+        log = self.run_manifest(m, resources={'db': 3})
+        self.assertEqual(len(log.order), 3)
+        self.assertEqual(log.max_running, 2)
+
+    def test_lock_amounts_are_limited_to_capacity(self):
+        log = self.run_manifest({'r': {'duration': None, 'locks': {'db': 5}}}, resources={'db': 2})
+        self.assertEqual(log.order, ['r'])
+
+    def test_batches_share_slots(self):
+        log = RunLog()
+        done = []
+        s = Scheduler(jobs=1)
+        s.submit(self.manifest(2), log.make_run, on_done=lambda: done.append(1))
+        s.submit({'other': {'duration': 0.2}}, log.make_run, on_done=lambda: done.append(2))
+        s.run()
+        self.assertEqual(log.max_running, 1)
+        self.assertEqual(sorted(done), [1, 2])
+
+
+class TestMaxtime(SchedulerTest):
+    def test_killed(self):
+        start = time.time()
+        log = RunLog()
+        s = Scheduler()
+        runs = []
+
+        def make_run(name, config):
+            runs.append(log.make_run(name, config))
+            return runs[-1]
+        s.submit({'slow': {'duration': 30, 'maxtime': 0.2}}, make_run)
+        s.run()
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue(runs[0].killed)
+        self.assertEqual(runs[0].returncode, -signal.SIGTERM)
+
+
+class TestExitStatus(unittest.TestCase):
+    def test_exitstatus_to_returncode(self):
+        self.assertEqual(exitstatus_to_returncode(0), 0)
+        self.assertEqual(exitstatus_to_returncode(3 << 8), 3)
+        self.assertEqual(exitstatus_to_returncode(signal.SIGKILL), -signal.SIGKILL)
+
+
+if __name__ == '__main__':
+    unittest.main()
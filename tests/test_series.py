@@ -0,0 +1,182 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from reportor import series
+
+
+class SeriesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.old_state_dir = os.environ.get('REPORTOR_STATE_DIR')
+        os.environ['REPORTOR_STATE_DIR'] = self.tmpdir
+
+    def tearDown(self):
+        if self.old_state_dir is None:
+            del os.environ['REPORTOR_STATE_DIR']
+        else:
+            os.environ['REPORTOR_STATE_DIR'] = self.old_state_dir
+        shutil.rmtree(self.tmpdir)
+
+    def make_series(self, samples, dtype='<f8'):
+        s = series.open_series('test', dtype)
+        s.extend(samples)
+        self.addCleanup(s.close)
+        return s
+
+
+class TestAppend(SeriesTest):
+    def test_append_and_extend(self):
+        s = self.make_series([(10, 1.0), (20, 2.0)])
+        s.append(20, 3.0)
+        times, values = s.columns()
+        self.assertEqual(times.tolist(), [10, 20, 20])
+        self.assertEqual(values.tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual(s.last(), (20, 3.0))
+        self.assertEqual(len(s), 3)
+
+    def test_out_of_order(self):
+        s = self.make_series([(10, 1.0)])
+        self.assertRaises(ValueError, s.append, 5, 2.0)
+        self.assertRaises(ValueError, s.extend, [(15, 2.0), (12, 3.0)])
+        # Nothing from a rejected extend is written
+        self.assertEqual(s.columns()[0].tolist(), [10])
+
+    def test_empty(self):
+        s = self.make_series([])
+        self.assertEqual(len(s), 0)
+        self.assertEqual(s.last(), None)
+        self.assertEqual(s.aggregate('count'), 0)
+        self.assertEqual(s.aggregate('sum'), None)
+
+    def test_int_dtype(self):
+        s = self.make_series([(1, 5), (2, 7)], dtype='<i8')
+        self.assertEqual(s.columns()[1].tolist(), [5, 7])
+        # The dtype comes from meta.json once the series exists
+        self.assertEqual(series.open_series('test').dtype, '<i8')
+
+    def test_bad_dtype(self):
+        self.assertRaises(ValueError, series.open_series, 'test', 'S10')
+
+    def test_partial_values_are_ignored(self):
+        s = self.make_series([(1, 1.0), (2, 2.0)])
+        # As if an append had been interrupted after writing its values
+        with open(s.value_path, 'ab') as f:
+            f.write('\0' * 12)
+        self.assertEqual(len(s), 2)
+        s.append(3, 3.0)
+        self.assertEqual(s.columns()[1].tolist(), [1.0, 2.0, 3.0])
+
+
+class TestColumn(SeriesTest):
+    def test_indexing(self):
+        s = self.make_series([(t, t * 10.0) for t in range(5)])
+        values = s.columns()[1]
+        self.assertEqual(values[0], 0.0)
+        self.assertEqual(values[-1], 40.0)
+        self.assertRaises(IndexError, lambda: values[5])
+        self.assertRaises(IndexError, lambda: values[-6])
+        self.assertEqual(list(values), [0.0, 10.0, 20.0, 30.0, 40.0])
+
+    def test_slicing(self):
+        s = self.make_series([(t, t * 10.0) for t in range(5)])
+        values = s.columns()[1]
+        self.assertEqual(values[1:3].tolist(), [10.0, 20.0])
+        self.assertEqual(values[-2:].tolist(), [30.0, 40.0])
+        self.assertEqual(values[1:4][1:].tolist(), [20.0, 30.0])
+        self.assertEqual(values[::2], [0.0, 20.0, 40.0])
+        self.assertEqual(len(values[4:1]), 0)
+
+
+class TestRange(SeriesTest):
+    def setUp(self):
+        SeriesTest.setUp(self)
+        self.s = self.make_series([(10, 1.0), (20, 2.0), (20, 3.0), (30, 4.0)])
+
+    def range(self, start=None, end=None):
+        times, values = self.s.range(start, end)
+        return zip(times.tolist(), values.tolist())
+
+    def test_everything(self):
+        self.assertEqual(len(self.range()), 4)
+
+    def test_start_inclusive_end_exclusive(self):
+        self.assertEqual(self.range(20, 30), [(20, 2.0), (20, 3.0)])
+        self.assertEqual(self.range(10, 20), [(10, 1.0)])
+
+    def test_between_samples(self):
+        self.assertEqual(self.range(15, 25), [(20, 2.0), (20, 3.0)])
+        self.assertEqual(self.range(start=25), [(30, 4.0)])
+        self.assertEqual(self.range(end=15), [(10, 1.0)])
+
+    def test_outside(self):
+        self.assertEqual(self.range(31), [])
+        self.assertEqual(self.range(end=10), [])
+        self.assertEqual(self.range(25, 15), [])
+
+    def test_bisect(self):
+        times = self.s.columns()[0]
+        self.assertEqual(series._bisect(times, 20), 1)
+        self.assertEqual(series._bisect(times, 20, right=True), 3)
+        self.assertEqual(series._bisect(times, 0), 0)
+        self.assertEqual(series._bisect(times, 99), 4)
+
+
+class TestAggregate(SeriesTest):
+    def setUp(self):
+        SeriesTest.setUp(self)
+        self.s = self.make_series([(0, 4.0), (30, 2.0), (60, 6.0), (150, 1.0)])
+
+    def test_aggregates(self):
+        expected = {'count': 4, 'sum': 13.0, 'min': 1.0, 'max': 6.0, 'avg': 3.25,
+                    'first': 4.0, 'last': 1.0}
+        for func, value in expected.items():
+            self.assertEqual(self.s.aggregate(func), value, func)
+
+    def test_range(self):
+        self.assertEqual(self.s.aggregate('sum', 30, 150), 8.0)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, self.s.aggregate, 'median')
+
+    def test_buckets(self):
+        # Empty buckets are left out
+        self.assertEqual(self.s.aggregate('sum', bucket=60), [(0, 6.0), (60, 6.0), (120, 1.0)])
+        self.assertEqual(self.s.aggregate('count', start=30, bucket=100), [(0, 2), (100, 1)])
+
+
+class TestNames(SeriesTest):
+    def test_bad_names(self):
+        for name in ('', '.hidden', '../x', 'a/b'):
+            self.assertRaises(ValueError, series.open_series, name)
+
+    def test_list_series(self):
+        self.assertEqual(series.list_series(), [])
+        series.record('b', 1, ts=1)
+        series.record('a', 1, ts=1)
+        os.makedirs(os.path.join(series.series_dir(), 'not-a-series'))
+        self.assertEqual(series.list_series(), ['a', 'b'])
+
+
+class TestRecord(SeriesTest):
+    def test_record(self):
+        self.assertTrue(series.record('r', 1.5, ts=100))
+        self.assertTrue(series.record('r', 2.5, ts=100))
+        # Older samples are skipped
+        self.assertFalse(series.record('r', 3.5, ts=50))
+        s = series.open_series('r')
+        self.addCleanup(s.close)
+        self.assertEqual(s.columns()[1].tolist(), [1.5, 2.5])
+
+    def test_default_time(self):
+        os.environ['REPORTOR_NOW'] = '1234'
+        self.addCleanup(os.environ.pop, 'REPORTOR_NOW')
+        series.record('r', 1.0)
+        s = series.open_series('r')
+        self.addCleanup(s.close)
+        self.assertEqual(s.last(), (1234, 1.0))
+
+
+if __name__ == '__main__':
+    unittest.main()